@@ -12,6 +12,8 @@ import pickle as pkl
 from metrics import *
 from trajectory_transition import extract_trajectory_transition
 from road_graph import extract_road_adj
+from flow_store import read_flows
+from postprocess import read_trajectory_metadata
 from model import *
 from sklearn.preprocessing import StandardScaler
 import argparse
@@ -70,6 +72,20 @@ def baseline_HA(df, previous_weeks=None, interval=15, test_ratio=0.25, history_w
     return y_pred, y_test
 
 
+def neighbor_adjacency(road_adj, hops=5):
+    # neighbor_adj[i, j] > 0 if road j is within hops of road i, in either direction (excluding i). 
+    # road_adj: scipy.sparse matrix. output: csr_matrix with sorted column indices of the neighbors only
+    symm_adj = (road_adj + road_adj.transpose()).tocsr()
+    neighbor_adj = symm_adj
+    for hop in range(hops-1):
+        neighbor_adj = neighbor_adj.dot(symm_adj) + symm_adj
+    neighbor_adj = neighbor_adj.tocsr()
+    neighbor_adj.setdiag(0) # exclude self
+    neighbor_adj.eliminate_zeros()
+    neighbor_adj.sort_indices()
+    return neighbor_adj
+
+
 # new version, considering only small neighborhood. updated 20200408.
 def baseline_VAR(flow_df, road_adj, hops=5, history_window=4, prediction_window=1, test_ratio=0.25):
     
@@ -78,11 +94,7 @@ def baseline_VAR(flow_df, road_adj, hops=5, history_window=4, prediction_window=
     n_timestamp_test = n_timestamp - n_timestamp_train
     
     # find neighbors for each node
-    symm_adj = road_adj+road_adj.transpose()
-    neighbor_adj = symm_adj
-    for hop in range(hops-1):
-        neighbor_adj = np.matmul(neighbor_adj, symm_adj) + symm_adj
-    np.fill_diagonal(neighbor_adj, 0) # exclude self
+    neighbor_adj = neighbor_adjacency(road_adj, hops=hops)
     
     train_data = np.array(flow_df.iloc[:n_timestamp_train]) # (n_timestamp_train, n_road)
     test_data = np.array(flow_df.iloc[n_timestamp_train:]) # (n_timestamp_test, n_road)
@@ -92,7 +104,7 @@ def baseline_VAR(flow_df, road_adj, hops=5, history_window=4, prediction_window=
     
     for road_index in range(n_road): 
         
-        filtered_roads = [road_index]+list(np.where(neighbor_adj[road_index]>0)[0])
+        filtered_roads = [road_index]+list(neighbor_adj[road_index].indices)
         filtered_train_data = np.array(train_data[:, filtered_roads])
         filtered_test_data = np.array(test_data[:, filtered_roads])
         
@@ -121,11 +133,7 @@ def baseline_RF(df, road_adj, hops=5, n_estimators=10, history_window=4, predict
     n_timestamp_test = n_timestamp - n_timestamp_train
     
     # find neighbors for each node
-    symm_adj = road_adj+road_adj.transpose()
-    neighbor_adj = symm_adj
-    for hop in range(hops-1):
-        neighbor_adj = np.matmul(neighbor_adj, symm_adj) + symm_adj
-    np.fill_diagonal(neighbor_adj, 0) # exclude self
+    neighbor_adj = neighbor_adjacency(road_adj, hops=hops)
     
     train_data = np.array(df.iloc[:n_timestamp_train]) # (n_timestamp_train, n_road)
     test_data = np.array(df.iloc[n_timestamp_train:]) # (n_timestamp_test, n_road)
@@ -138,7 +146,7 @@ def baseline_RF(df, road_adj, hops=5, n_estimators=10, history_window=4, predict
     
     for road_index in range(n_road): 
         
-        filtered_roads = [road_index]+list(np.where(neighbor_adj[road_index]>0)[0])
+        filtered_roads = [road_index]+list(neighbor_adj[road_index].indices)
         
         n_sample_train = n_timestamp_train - history_window - prediction_window + 1 
         X_train = np.concatenate([np.expand_dims(train_data[i : (n_sample_train + i), filtered_roads], axis=2) for i in range(history_window)], axis=2) # (n_sample, n_filtered_road, history_window)
@@ -196,20 +204,17 @@ if __name__ == '__main__':
         start_date, end_date = '20160314', '20160508' # train (5 weeks) + validation (1 week) + test (2 weeks)
     else:
         start_date, end_date = '20160401', '20160428' # train + validation + test
-    dates = date_range(start_date, end_date)
-    flow_df = pd.concat([pd.read_csv('data/flow_%s_%s.csv'%(date, date), index_col=0) for date in dates])
-    flow_df.columns = pd.Index(int(road_id) for road_id in flow_df.columns)
+    flow_df = read_flows(start_date, end_date, interval=15) # from the flow store
     if calibrate:
         print_log('Calibrating flow...', log_path)
-        trajectory_metadata = pd.read_csv('data/trajectory_metadata.csv') # read trajectory metadata
+        trajectory_metadata = read_trajectory_metadata(start_date, end_date) # read trajectory metadata of the dates of flow_df
         multipliers = np.repeat(np.array(trajectory_metadata['vehicles'][0] / trajectory_metadata['vehicles']), 96)
         multipliers[multipliers==np.inf]=0
         flow_df = flow_df.mul(multipliers, axis=0)
     print_log('flow_df: ' + str(flow_df.shape), log_path)
     print_log('Total flow: %d'%(flow_df.sum().sum()), log_path)
     # Dataset: road_adj
-    road_adj = extract_road_adj()
-    road_adj # upper triangular
+    road_adj = extract_road_adj() # sparse
     print_log('road_adj: ' + str(road_adj.shape), log_path)
 
     # parameters
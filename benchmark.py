@@ -0,0 +1,88 @@
+# python benchmark.py -s trajectory|flow|transition [-d 20160314 -r 3]
+import time
+import argparse
+import numpy as np
+import pandas as pd
+
+
+def benchmark_trajectory(date='20160314', repeat=3):
+    # throughput of trajectory extraction (Scenarios 0.2, 1.1-1.4), in GPS readings per second
+    from road_graph import get_road_list, road_graph
+    from graph_store import to_networkx
+    import trajectory
+
+    road_list = get_road_list(road_df=None, out_path='data/road_list.csv', update=False)
+    G = to_networkx(road_graph(road_df=None, out_path='data/road_graph.gml', update=False))
+    df = trajectory.read_GPS_dataset(date_range=[date, date], in_path='data/ParsedTaxiData_%s.csv')
+    grouped_readings = trajectory.group_vehicle_readings(df, road_list)
+    vehicle_dfs = [trajectory.extract_vehicle_readings(grouped_readings, vehicle_id) for vehicle_id in df['vehicle_id'].unique()]
+    n_rows = sum(len(vehicle_df) for vehicle_df in vehicle_dfs)
+
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        for vehicle_df in vehicle_dfs:
+            trajectory.extract_trajectory(vehicle_df, G, verb=False)
+        timings.append(time.time() - start_time)
+    best = min(timings)
+    print('extract_trajectory: %d readings, %d vehicles, best of %d: %.3f s, %.0f rows/s'%(n_rows, len(vehicle_dfs), repeat, best, n_rows / best))
+    return n_rows / best
+
+
+def benchmark_flow(date='20160314', repeat=3, interval=15):
+    # throughput of flow aggregation, in recovered trajectory points per second
+    from road_graph import get_road_list
+    from trajectory_store import read_recovered_trajectory
+    from utils import date_timestamp
+    import flow
+
+    road_list = get_road_list(road_df=None, out_path='data/road_list.csv', update=False)
+    trajectory = read_recovered_trajectory(date, date, road_list, columns=['vehicle_index', 'trajectory_id', 'timestamp', 'road_index'])
+    n_rows = len(trajectory['road_index'])
+
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        entry = flow.entry_events(trajectory['vehicle_index'], trajectory['trajectory_id'], trajectory['road_index'])
+        slots = (trajectory['timestamp'] - date_timestamp(date)) // (interval * 60)
+        flow.aggregate_flow(slots, trajectory['road_index'], entry, 24 * 60 // interval, len(road_list))
+        timings.append(time.time() - start_time)
+    best = min(timings)
+    print('aggregate_flow: %d points, best of %d: %.3f s, %.0f rows/s'%(n_rows, repeat, best, n_rows / best))
+    return n_rows / best
+
+
+def benchmark_transition(date='20160314', repeat=3, interval=15):
+    # throughput of trajectory transition counting, in recovered trajectory points per second
+    from road_graph import get_road_list
+    from trajectory_store import read_recovered_trajectory
+    import trajectory_transition
+
+    road_list = get_road_list(road_df=None, out_path='data/road_list.csv', update=False)
+    trajectory = read_recovered_trajectory(date, date, road_list, columns=['vehicle_index', 'trajectory_id', 'timestamp', 'road_index'])
+    n_rows = len(trajectory['road_index'])
+    shape = (60 // interval * 24, len(road_list), len(road_list))
+
+    timings = []
+    for _ in range(repeat):
+        start_time = time.time()
+        trajectory_transition.count_transitions(trajectory['vehicle_index'], trajectory['trajectory_id'], trajectory['road_index'], trajectory['timestamp'], 
+                                                shape, interval=interval)
+        timings.append(time.time() - start_time)
+    best = min(timings)
+    print('count_transitions: %d points, best of %d: %.3f s, %.0f rows/s'%(n_rows, repeat, best, n_rows / best))
+    return n_rows / best
+
+
+if __name__ == '__main__':
+
+    # Arguments
+    parser = argparse.ArgumentParser(description='benchmark')
+    parser.add_argument('-s', '--stage', help='trajectory, flow or transition', required=True)
+    parser.add_argument('-d', '--date', help='%Y%m%d', default='20160314')
+    parser.add_argument('-r', '--repeat', default=3)
+    args = parser.parse_args()
+    stage, date, repeat = args.stage, args.date, int(args.repeat)
+
+    stages = {'trajectory': benchmark_trajectory, 'flow': benchmark_flow, 'transition': benchmark_transition}
+    stages[stage](date=date, repeat=repeat)
@@ -0,0 +1,74 @@
+import os
+import shutil
+import hashlib
+import numpy as np
+import torch
+
+
+# Feature cache of the TrGNN models (see model.py): the graph propagation of the flow of each (day, time slot), computed once.
+# Graph propagation has no learnable parameters, so that an epoch on cached features only runs the attention and output layers.
+# One directory per key, one .npy file per feature, read as memory-mapped arrays:
+#   H: float32 (n_day, n_slot, n_road, demand_hop+1). demand propagation, through T of the time of day of the slot
+#   S: float32 (n_day, n_slot, n_road, 2**(status_hop+1)-1). status propagation, through W_norm
+# Sample (d, t) reads slots t to t+history_window-1 of day d, shared with the overlapping samples.
+# The key hashes the model type and hops, the normalized flow and the propagation matrices: changed inputs build a new cache.
+FEATURES = ['H', 'S']
+
+
+def feature_cache_key(model, normalized_flows, transitions, W_norm):
+    # normalized_flows: tensor (n_day*n_slot, n_road). transitions: list of n_slot sparse_tensors. W_norm: sparse_tensor
+    key = hashlib.sha1(('%s_%d_%d'%(type(model).__name__, model.demand_hop, model.status_hop)).encode())
+    key.update(normalized_flows.cpu().numpy().tobytes())
+    for matrix in list(transitions) + [W_norm]:
+        key.update(matrix._indices().cpu().numpy().tobytes())
+        key.update(matrix._values().cpu().numpy().tobytes())
+    return key.hexdigest()[:16]
+
+
+def feature_cache_path(key):
+    return 'data/feature_cache_%s'%(key)
+
+
+def build_feature_cache(model, normalized_flows, transitions, W_norm, cache_path, chunk_days=8):
+    # Propagate the flow of each slot of chunk_days days at once, as the history steps of one sample (model.propagate).
+    n_slot = len(transitions)
+    n_day, n_road = normalized_flows.shape[0] // n_slot, normalized_flows.shape[1]
+    flows = normalized_flows[:n_day*n_slot].view(n_day, n_slot, n_road)
+    print('Building feature cache of %d days x %d slots at %s'%(n_day, n_slot, cache_path))
+    temp_cache_path = '%s_temp'%(cache_path)
+    if not os.path.exists(temp_cache_path):
+        os.makedirs(temp_cache_path)
+    shapes = {'H': (n_day, n_slot, n_road, model.demand_hop+1), 'S': (n_day, n_slot, n_road, 2**(model.status_hop+1)-1)}
+    features = {name: np.lib.format.open_memmap(os.path.join(temp_cache_path, '%s.npy'%(name)), mode='w+', dtype=np.float32, shape=shapes[name])
+                for name in FEATURES}
+    with torch.no_grad():
+        for slot in range(n_slot):
+            for day in range(0, n_day, chunk_days):
+                X = flows[day:day+chunk_days, slot] # (chunk_days, n_road)
+                H, S = model.propagate(X, (transitions[slot],) * X.shape[0], W_norm)
+                features['H'][day:day+chunk_days, slot] = H.cpu().numpy()
+                features['S'][day:day+chunk_days, slot] = S.cpu().numpy()
+    for name in FEATURES:
+        features[name].flush()
+    del features
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(temp_cache_path, cache_path)
+
+
+def read_feature_cache(cache_path):
+    # output: (H, S), read-only memory-mapped arrays
+    return tuple(np.load(os.path.join(cache_path, '%s.npy'%(name)), mmap_mode='r') for name in FEATURES)
+
+
+def cached_features(model, normalized_flows, transitions, W_norm):
+    # (H, S) of the feature cache of the inputs, built if missing
+    cache_path = feature_cache_path(feature_cache_key(model, normalized_flows, transitions, W_norm))
+    if not os.path.exists(cache_path):
+        build_feature_cache(model, normalized_flows, transitions, W_norm, cache_path)
+    return read_feature_cache(cache_path)
+
+
+def feature_window(features, d, t, history_window=4):
+    # features of sample (d, t): slots t to t+history_window-1 of day d. tensor: (history_window, n_road, n_feature)
+    return torch.from_numpy(np.array(features[d, t:t+history_window]))
@@ -1,34 +1,135 @@
 # nohup python flow.py -d 20160325 -i 5 >> log/flow0325.log &
+# nohup python flow.py -d 20160325 -i 5,15,60 >> log/flow0325.log &
 import os
 import time
+import pickle as pkl
 import pandas as pd
 import numpy as np
 import argparse
 from datetime import datetime as dt
 from datetime import date, timedelta
-from utils import time_difference, round_time, df_to_csv
-from road_graph import get_road_list, road_graph
+from utils import to_time_string, date_timestamp, df_to_csv
+from road_graph import get_road_list
+from trajectory_store import read_recovered_trajectory
+from flow_store import flow_store_path, write_flow_day
 
 
 def generate_time_intervals(start_date='20160325', end_date='20160325', interval=5):
-    start_time = int(time.mktime(dt.strptime(start_date, '%Y%m%d').timetuple()))
-    end_time = int(time.mktime((dt.strptime(end_date, '%Y%m%d') + timedelta(1)).timetuple()))
+    start_time = date_timestamp(start_date)
+    end_time = date_timestamp(end_date) + 86400
     interval = interval * 60 # convert minutes to seconds
-    time_intervals = []
-    for timestamp in range(start_time, end_time, interval):
-        time_intervals.append(dt.fromtimestamp(timestamp / interval * interval).strftime('%d/%m/%Y %H:%M:%S'))
+    time_intervals = list(to_time_string(np.arange(start_time, end_time, interval)))
     return time_intervals
 
 
+def entry_events(vehicle_index, trajectory_ids, road_index):
+    # A vehicle appears in a road segment at the first point of each trajectory, and whenever its road segment changes.
+    # inputs: arrays of recovered trajectory points, sorted by (vehicle, trajectory, time). output: bool array
+    entry = np.ones(len(road_index), dtype=bool)
+    entry[1:] = (vehicle_index[1:] != vehicle_index[:-1]) | (trajectory_ids[1:] != trajectory_ids[:-1]) | (road_index[1:] != road_index[:-1])
+    return entry
+
+
+def aggregate_flow(slots, road_index, entry, n_intervals, n_roads):
+    # Count entry events per (time interval, road segment) with a scatter-add.
+    # slots: index of the time interval of each point. road_index: index in road_list, -1 for other roads.
+    # output: int64 array of shape (n_intervals, n_roads)
+    valid = entry & (slots >= 0) & (slots < n_intervals) & (road_index >= 0)
+    cells = slots[valid] * n_roads + road_index[valid]
+    return np.bincount(cells, minlength=n_intervals * n_roads).reshape(n_intervals, n_roads)
+
+
+def coarsen_flow(flow, factor):
+    # Flow at a coarser interval, by summing each group of factor consecutive intervals.
+    # flow: array of shape (n_intervals, n_roads), with n_intervals a multiple of factor
+    return flow.reshape(flow.shape[0] // factor, factor, flow.shape[1]).sum(axis=1)
+
+
+# Checkpoint log: append-only file of pickled records.
+#   ('header', interval, shape): finest interval and shape of the flow array
+#   (index, cells, counts): counts added to flow.flat[cells] by the points up to index
+# Resuming replays the records, and the log is compacted to a single record of the whole flow at the end.
+
+def read_checkpoint_log(log_path, interval, shape):
+    # output: (flow, index of the next point to aggregate). Empty flow if the log is missing or does not match.
+    flow = np.zeros(shape, dtype=np.int64)
+    if not os.path.exists(log_path):
+        return flow, 0
+    checkpoint = 0
+    with open(log_path, 'rb') as f:
+        try:
+            header = pkl.load(f)
+        except Exception:
+            header = None
+        if header != ('header', interval, shape):
+            print('Checkpoint log does not match. Ignored.')
+            return flow, 0
+        offset = f.tell()
+        while True:
+            try:
+                index, cells, counts = pkl.load(f)
+            except EOFError:
+                break
+            except Exception: # record truncated by a crash
+                print('Truncated checkpoint record ignored')
+                break
+            np.add.at(flow.reshape(-1), cells, counts)
+            checkpoint = index + 1
+            offset = f.tell()
+    with open(log_path, 'r+b') as f:
+        f.truncate(offset) # drop a truncated record, if any
+    return flow, checkpoint
+
+
+def write_checkpoint_log(log_path, interval, flow, index=None):
+    # Start a new log with its header. With index, also record the whole flow so far (compaction).
+    temp_log_path = '%s_temp'%(log_path)
+    with open(temp_log_path, 'wb') as f:
+        pkl.dump(('header', interval, flow.shape), f)
+        if index is not None:
+            cells = np.flatnonzero(flow)
+            pkl.dump((index, cells.astype(np.int32), flow.reshape(-1)[cells]), f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(temp_log_path, log_path)
+
+
+def append_checkpoint_log(log_path, index, delta):
+    # Append the counts changed by the points up to index. delta: array of the flow shape
+    cells = np.flatnonzero(delta)
+    with open(log_path, 'ab') as f:
+        pkl.dump((index, cells.astype(np.int32), delta.reshape(-1)[cells].astype(np.int32)), f)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def flow_csv_paths(start_date, end_date, intervals):
+    # flow file of each interval, suffixed with the interval when there are several
+    if len(intervals) == 1:
+        return ['data/flow_%s_%s.csv'%(start_date, end_date)]
+    return ['data/flow_%s_%s_%dmin.csv'%(start_date, end_date, interval) for interval in intervals]
+
+
+def save_flows(flow, intervals, flow_paths, start_date, end_date, road_ids):
+    # Save flow (at the finest interval, intervals[0]) at each of intervals
+    for interval, flow_path in zip(intervals, flow_paths):
+        time_intervals = generate_time_intervals(start_date=start_date, end_date=end_date, interval=interval)
+        df_to_csv(pd.DataFrame(coarsen_flow(flow, interval // intervals[0]), index=time_intervals, columns=road_ids), flow_path, index=True)
+
+
 if __name__ == '__main__':
     
     # Arguments
     parser = argparse.ArgumentParser(description='flow')
     parser.add_argument('-d', '--date', help='%Y%m%d', required=True)
     parser.add_argument('-t', '--test_mode', default=0)
-    parser.add_argument('-i', '--interval', help='in minutes', default=5)
+    parser.add_argument('-i', '--interval', help='in minutes. several intervals separated by comma, e.g. 5,15,60', default='5')
     args = parser.parse_args()
-    date, test_mode, interval = args.date, int(args.test_mode), int(args.interval)
+    date, test_mode = args.date, int(args.test_mode)
+    intervals = sorted(set(int(interval) for interval in str(args.interval).split(',')))
+    for interval in intervals:
+        if interval % intervals[0] != 0 or (24 * 60) % interval != 0:
+            parser.error('intervals should divide a day, and be multiples of the finest interval %d'%(intervals[0]))
 
     # Parameter Settings
     # start_date = '20160325'
@@ -36,64 +137,55 @@ if __name__ == '__main__':
     # interval = 5
     start_date = date
     end_date = date
-    interval = interval # in minutes
-    flow_path = 'data/flow_%s_%s.csv'%(start_date, end_date)
+    interval = intervals[0] # in minutes. finest interval, from which the coarser ones are derived
+    flow_paths = flow_csv_paths(start_date, end_date, intervals)
     checkpoint_path = 'data/flow_%s_%s.checkpoint'%(start_date, end_date)
-    trajectory_path = 'data/recovered_trajectory_df_%s_%s.csv'%(start_date, end_date)
     road_list_path = 'data/road_list.csv'
+    block_size = 100000 # points aggregated between checkpoints
     test_mode = test_mode
     
     
     # read trajectories
     print('Reading trajectories')
+    road_list = get_road_list(road_df=None, out_path=road_list_path, update=False)
+    trajectory = read_recovered_trajectory(start_date, end_date, road_list, columns=['vehicle_index', 'trajectory_id', 'timestamp', 'road_index'])
     if test_mode:
         print('------- test mode -------')
-        recovered_trajectory_df = pd.read_csv(trajectory_path, nrows=200)
-    else:
-        recovered_trajectory_df = pd.read_csv(trajectory_path)
-
-    # initialize flow_df
-    print('Initializing flow_df')
-    if os.path.exists(flow_path):
-        print('Flow file exists')
-        flow_df = pd.read_csv(flow_path, index_col=0)
-        flow_df.columns = pd.Index(int(road_id) for road_id in flow_df.columns)
-        print('Existing total flow:', flow_df.sum().sum())
-        with open(checkpoint_path, 'r') as f:
-            checkpoint = int(f.read()) + 1
+        trajectory = {column: values[:200] for column, values in trajectory.items()}
+
+    # initialize flow, from the checkpoint log if any
+    print('Initializing flow')
+    time_intervals = generate_time_intervals(start_date=start_date, end_date=end_date, interval=interval)
+    road_ids = road_list['road_id'].values
+    flow, checkpoint = read_checkpoint_log(checkpoint_path, interval, (len(time_intervals), len(road_ids)))
+    if checkpoint > 0:
+        print('Checkpoint log exists')
+        print('Existing total flow:', flow.sum())
     else:
-        print('Creating new flow file')
-        road_list = get_road_list(road_df=None, out_path=road_list_path, update=False)
-        flow_df = pd.DataFrame(columns=list(road_list['road_id']))
-        time_intervals = generate_time_intervals(start_date=start_date, end_date=end_date, interval=interval)
-        for time_interval in time_intervals:
-            flow_df.loc[time_interval] = 0
-        checkpoint = 0
+        print('Creating new checkpoint log')
+        write_checkpoint_log(checkpoint_path, interval, flow)
 
-    # aggregate and save flow
-    # flow is saved to file in overwrite mode
-    print('Total number of points:', len(recovered_trajectory_df))
+    # aggregate flow
+    # the counts changed by each block of points are appended to the checkpoint log
+    n_points = len(trajectory['road_index'])
+    print('Total number of points:', n_points)
     start_time = time.time()
-    i = -1 # dummy
-    for i, row in recovered_trajectory_df.iterrows():
-        if i < checkpoint:
-            pass
-        elif i == 0:
-            flow_df.loc[round_time(row['time'], interval=interval), row['road_id']] += 1
-        else:
-            if i % 10000 == 0:
-                print('Saving result at index %s. Time spent: %s s'%(i, int(time.time() - start_time)))
-                df_to_csv(flow_df, flow_path, index=True)
-                with open(checkpoint_path, 'w') as f:
-                    f.write(str(i))
-            if row['vehicle_id'] != previous_vehicle_id or row['trajectory_id'] != previous_trajectory_id: # new trajectory
-                flow_df.loc[round_time(row['time'], interval=interval), row['road_id']] += 1
-            elif row['road_id'] != previous_road_id: # appear in this road
-                flow_df.loc[round_time(row['time'], interval=interval), row['road_id']] += 1
-        previous_vehicle_id, previous_trajectory_id, previous_road_id = row['vehicle_id'], row['trajectory_id'], row['road_id']
-    print('Saving result at index', i)
-    df_to_csv(flow_df, flow_path, index=True)
-    with open(checkpoint_path, 'w') as f:
-        f.write(str(i))
-    print('New total flow:', flow_df.sum().sum())
+    entry = entry_events(trajectory['vehicle_index'], trajectory['trajectory_id'], trajectory['road_index'])
+    slots = (trajectory['timestamp'] - date_timestamp(start_date)) // (interval * 60)
+    i = checkpoint - 1
+    for block_start in range(checkpoint, n_points, block_size):
+        block = slice(block_start, min(block_start + block_size, n_points))
+        delta = aggregate_flow(slots[block], trajectory['road_index'][block], entry[block], len(time_intervals), len(road_ids))
+        flow += delta
+        i = block.stop - 1
+        print('Checkpoint at index %s. Time spent: %s s'%(i, int(time.time() - start_time)))
+        append_checkpoint_log(checkpoint_path, i, delta)
+
+    # save flow, and compact the checkpoint log
+    save_flows(flow, intervals, flow_paths, start_date, end_date, road_ids)
+    for store_interval in intervals: # add the date to the flow store of each interval
+        print('Saving to flow store at %s'%(flow_store_path(store_interval)))
+        write_flow_day(flow_store_path(store_interval), start_date, coarsen_flow(flow, store_interval // intervals[0]), road_ids, interval=store_interval)
+    write_checkpoint_log(checkpoint_path, interval, flow, index=i)
+    print('New total flow:', flow.sum())
     print('Finished flow aggregation. Total time spent: %.2f hour.'%((time.time() - start_time)/3600))
@@ -0,0 +1,114 @@
+# python flow_store.py -d1 20160314 -d2 20160314 [-i 15]
+import os
+import argparse
+import numpy as np
+import pandas as pd
+from utils import date_range, date_timestamp, to_time_string
+
+
+# Memory-mapped store of flows at one interval, one directory per interval:
+#   flow.dat: float32 array of shape (days, intervals of day, roads), in C order. Days are appended in place.
+#   dates.csv: date ('%Y%m%d') of each day of flow.dat, in order
+#   road_ids.npy: road_id of each road index
+# A date range stored in order is opened as a view of the file, without parsing text.
+FLOW_DTYPE = np.float32
+
+
+def flow_store_path(interval=15):
+    return 'data/flow_store_%dmin'%(interval)
+
+
+def flow_csv_path(date, interval=15):
+    # flow CSV of flow.py for a single date. Suffixed with the interval when several intervals were aggregated.
+    flow_path = 'data/flow_%s_%s_%dmin.csv'%(date, date, interval)
+    return flow_path if os.path.exists(flow_path) else 'data/flow_%s_%s.csv'%(date, date)
+
+
+def read_flow_store_index(store_path):
+    # output: (dates, road_ids). dates: list of '%Y%m%d', road_ids: np.array
+    dates = list(pd.read_csv(os.path.join(store_path, 'dates.csv'), dtype={'date': str})['date'])
+    road_ids = np.load(os.path.join(store_path, 'road_ids.npy'))
+    return dates, road_ids
+
+
+def open_flow_store(store_path, interval=15, mode='r'):
+    # output: (flow, dates, road_ids). flow: np.memmap of shape (len(dates), intervals of day, len(road_ids))
+    dates, road_ids = read_flow_store_index(store_path)
+    shape = (len(dates), 24 * 60 // interval, len(road_ids))
+    if len(dates) == 0:
+        return np.zeros(shape, dtype=FLOW_DTYPE), dates, road_ids
+    flow = np.memmap(os.path.join(store_path, 'flow.dat'), dtype=FLOW_DTYPE, mode=mode, shape=shape)
+    return flow, dates, road_ids
+
+
+def write_flow_day(store_path, date, flow, road_ids, interval=15):
+    # Save the flow of one date, in place if the date is stored already, otherwise appended.
+    # flow: array of shape (intervals of day, len(road_ids)). road_ids: roads of the columns of flow.
+    if not os.path.exists(store_path):
+        os.makedirs(store_path)
+        np.save(os.path.join(store_path, 'road_ids.npy'), np.asarray(road_ids, dtype=np.int64))
+        pd.DataFrame({'date': []}).to_csv(os.path.join(store_path, 'dates.csv'), index=False)
+    dates, store_road_ids = read_flow_store_index(store_path)
+    flow = pd.DataFrame(flow, columns=road_ids).reindex(columns=store_road_ids).fillna(0).values.astype(FLOW_DTYPE)
+    if flow.shape[0] != 24 * 60 // interval:
+        raise ValueError('flow of %s has %d intervals, expected %d'%(date, flow.shape[0], 24 * 60 // interval))
+    flow_path = os.path.join(store_path, 'flow.dat')
+    if date in dates:
+        stored_flow, _, _ = open_flow_store(store_path, interval=interval, mode='r+')
+        stored_flow[dates.index(date)] = flow
+        stored_flow.flush()
+        return
+    day_size = flow.size * np.dtype(FLOW_DTYPE).itemsize
+    with open(flow_path, 'ab') as f:
+        f.truncate(len(dates) * day_size) # drop a day written by an interrupted append
+        f.write(flow.tobytes())
+        f.flush()
+        os.fsync(f.fileno())
+    temp_dates_path = os.path.join(store_path, 'dates.csv_temp')
+    pd.DataFrame({'date': dates + [date]}).to_csv(temp_dates_path, index=False)
+    os.rename(temp_dates_path, os.path.join(store_path, 'dates.csv'))
+
+
+def import_flow_csv(store_path, date, interval=15):
+    # Import the flow CSV of a date into the store
+    flow_path = flow_csv_path(date, interval=interval)
+    print('Importing %s into flow store'%(flow_path))
+    flow_df = pd.read_csv(flow_path, index_col=0)
+    road_ids = np.array([int(road_id) for road_id in flow_df.columns])
+    write_flow_day(store_path, date, flow_df.values, road_ids, interval=interval)
+
+
+def read_flows(start_date, end_date, interval=15):
+    # Flows of all intervals from start_date to end_date, from the flow store. Dates missing in the store are imported from CSV.
+    # output: DataFrame of shape (days * intervals of day, roads), indexed by time interval, with int road_id columns.
+    #         For dates stored in order, its values are a read-only view of the memory-mapped store.
+    store_path = flow_store_path(interval)
+    dates = date_range(start_date, end_date)
+    stored_dates = read_flow_store_index(store_path)[0] if os.path.exists(store_path) else []
+    for date in dates:
+        if date not in stored_dates:
+            import_flow_csv(store_path, date, interval=interval)
+    flow, stored_dates, road_ids = open_flow_store(store_path, interval=interval)
+    positions = [stored_dates.index(date) for date in dates]
+    if positions == list(range(positions[0], positions[0] + len(positions))):
+        flow = flow[positions[0]:positions[0] + len(positions)] # view
+    else:
+        flow = flow[positions] # copy
+    time_intervals = to_time_string(np.concatenate([np.arange(date_timestamp(date), date_timestamp(date) + 86400, interval * 60) for date in dates]))
+    return pd.DataFrame(flow.reshape(-1, len(road_ids)), index=time_intervals, columns=pd.Index(road_ids), copy=False)
+
+
+if __name__ == '__main__':
+
+    # Import flow CSV files of a date range into the flow store
+    parser = argparse.ArgumentParser(description='flow_store')
+    parser.add_argument('-d1', '--start_date', help='%Y%m%d', required=True)
+    parser.add_argument('-d2', '--end_date', help='%Y%m%d', required=True)
+    parser.add_argument('-i', '--interval', help='in minutes', default=15)
+    args = parser.parse_args()
+    start_date, end_date, interval = args.start_date, args.end_date, int(args.interval)
+
+    store_path = flow_store_path(interval)
+    for date in date_range(start_date, end_date):
+        import_flow_csv(store_path, date, interval=interval)
+    print('Flow store: %s days at %s'%(len(read_flow_store_index(store_path)[0]), store_path))
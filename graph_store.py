@@ -0,0 +1,88 @@
+# python graph_store.py -g data/road_graph.gml [-e 1]
+import os
+import shutil
+import argparse
+import numpy as np
+import networkx as nx
+
+
+# Binary CSR store of the road graph. One directory per graph, one .npy file per array:
+#   road_ids: int64 (n_node). road_id of each node index, in node order of the graph
+#   lengths: float64 (n_node). node attribute 'length', in km
+#   offsets: int64 (n_node + 1). out-edges of node index i are offsets[i]:offsets[i+1]
+#   neighbors: int32 (n_edge). node index of the destination of each edge
+#   weights: float64 (n_edge). edge attribute 'weight'
+# Edges are kept in the adjacency order of the graph, so that shortest-path ties resolve as with the graph read from GML.
+GRAPH_ARRAYS = ['road_ids', 'lengths', 'offsets', 'neighbors', 'weights']
+
+
+def graph_store_path(graph_path='data/road_graph.gml'):
+    # data/road_graph.gml -> data/road_graph
+    return os.path.splitext(graph_path)[0]
+
+
+def graph_store_current(store_path, graph_path):
+    # True if the store exists and is not older than the GML file (if any)
+    offsets_path = os.path.join(store_path, 'offsets.npy')
+    if not os.path.exists(offsets_path):
+        return False
+    return not os.path.exists(graph_path) or os.path.getmtime(offsets_path) >= os.path.getmtime(graph_path)
+
+
+def write_graph_store(G, store_path):
+    # G: nx.DiGraph with int road_id nodes, node attribute 'length' and edge attribute 'weight'
+    print('Saving graph store at %s'%(store_path))
+    road_ids = np.array(list(G.nodes), dtype=np.int64)
+    node_index = dict(zip(road_ids.tolist(), range(len(road_ids))))
+    edges = list(G.edges(data='weight')) # grouped by origin, in node order
+    arrays = {'road_ids': road_ids,
+              'lengths': np.array([length for _, length in G.nodes(data='length', default=np.nan)], dtype=np.float64),
+              'offsets': np.concatenate([[0], np.cumsum([degree for _, degree in G.out_degree()])]).astype(np.int64),
+              'neighbors': np.array([node_index[edge[1]] for edge in edges], dtype=np.int32),
+              'weights': np.array([edge[2] for edge in edges], dtype=np.float64)}
+    temp_store_path = '%s_temp'%(store_path)
+    if not os.path.exists(temp_store_path):
+        os.makedirs(temp_store_path)
+    for name in GRAPH_ARRAYS:
+        np.save(os.path.join(temp_store_path, '%s.npy'%(name)), arrays[name])
+    if os.path.exists(store_path):
+        shutil.rmtree(store_path)
+    os.rename(temp_store_path, store_path)
+
+
+def read_graph_store(store_path, mmap=True):
+    # output: dict of array name -> np.array (read-only views of the files if mmap)
+    mmap_mode = 'r' if mmap else None
+    return {name: np.load(os.path.join(store_path, '%s.npy'%(name)), mmap_mode=mmap_mode) for name in GRAPH_ARRAYS}
+
+
+def store_edges(store):
+    # output: (origins, destinations, weights), arrays of the edges. origins and destinations are road_id.
+    origins = np.repeat(store['road_ids'], np.diff(store['offsets']))
+    return origins, np.asarray(store['road_ids'])[store['neighbors']], np.asarray(store['weights'])
+
+
+def to_networkx(store):
+    # Adapter for code that needs networkx (e.g. shortest paths): nx.DiGraph as read from GML, with the same node and edge order.
+    G = nx.DiGraph()
+    G.add_nodes_from((road_id, {'length': length}) for road_id, length in zip(store['road_ids'].tolist(), store['lengths'].tolist()))
+    origins, destinations, weights = store_edges(store)
+    G.add_weighted_edges_from(zip(origins.tolist(), destinations.tolist(), weights.tolist()))
+    return G
+
+
+if __name__ == '__main__':
+
+    # Import a GML road graph into the graph store, or export it back with -e 1
+    parser = argparse.ArgumentParser(description='graph_store')
+    parser.add_argument('-g', '--graph_path', help='GML file', default='data/road_graph.gml')
+    parser.add_argument('-e', '--export', help='1: export store to GML', default=0)
+    args = parser.parse_args()
+    graph_path, export = args.graph_path, int(args.export)
+
+    store_path = graph_store_path(graph_path)
+    if export:
+        print('Exporting graph store to %s'%(graph_path))
+        nx.write_gml(to_networkx(read_graph_store(store_path)), graph_path)
+    else:
+        write_graph_store(nx.relabel_nodes(nx.read_gml(graph_path), int), store_path)
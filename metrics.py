@@ -52,8 +52,8 @@ def result_analysis(Y_pred, Y_true, log_path='nohup.out'):
     print_log('>> result analysis - abnormal day 22nd Apr. MAE: %.3f, MAPE: %.3f, RMSE: %.3f'%(mae, mape, rmse), log_path)
     
     # abnormal hours: 8am-9am
-    _Y_pred = np.zeros((4*7, 2404)) # (n_sample, n_road)
-    _Y_true = np.zeros((4*7, 2404))
+    _Y_pred = np.zeros((4*7, Y_pred.shape[1])) # (n_sample, n_road)
+    _Y_true = np.zeros((4*7, Y_pred.shape[1]))
     for i in range(7):
         _Y_pred[i*4:(i+1)*4] = Y_pred[((8-1)*4+92*i):((9-1)*4+92*i)]
         _Y_true[i*4:(i+1)*4] = Y_true[((8-1)*4+92*i):((9-1)*4+92*i)]
@@ -63,8 +63,8 @@ def result_analysis(Y_pred, Y_true, log_path='nohup.out'):
     print_log('>> result analysis - abnormal hours 8am-9am. MAE: %.3f, MAPE: %.3f, RMSE: %.3f'%(mae, mape, rmse), log_path)
     
     # abnormal hours: 11pm-12am
-    _Y_pred = np.zeros((4*7, 2404)) # (n_sample, n_road)
-    _Y_true = np.zeros((4*7, 2404))
+    _Y_pred = np.zeros((4*7, Y_pred.shape[1])) # (n_sample, n_road)
+    _Y_true = np.zeros((4*7, Y_pred.shape[1]))
     for i in range(7):
         _Y_pred[i*4:(i+1)*4] = Y_pred[((23-1)*4+92*i):((24-1)*4+92*i)]
         _Y_true[i*4:(i+1)*4] = Y_true[((23-1)*4+92*i):((24-1)*4+92*i)]
@@ -100,8 +100,8 @@ def result_analysis2(Y_pred, Y_true, model_type='ours', log_path='nohup.out'):
     hours = np.arange(1, 24)
     for hour in hours:
         
-        _Y_pred = np.zeros((4*14, 2404)) # (n_sample, n_road)
-        _Y_true = np.zeros((4*14, 2404))
+        _Y_pred = np.zeros((4*14, Y_pred.shape[1])) # (n_sample, n_road)
+        _Y_true = np.zeros((4*14, Y_pred.shape[1]))
         for i in range(14):
             _Y_pred[i*4:(i+1)*4] = Y_pred[(hour*4-interval_offset+ToD*i):((hour+1)*4-interval_offset+ToD*i)]
             _Y_true[i*4:(i+1)*4] = Y_true[(hour*4-interval_offset+ToD*i):((hour+1)*4-interval_offset+ToD*i)]
@@ -117,8 +117,8 @@ def result_analysis2(Y_pred, Y_true, model_type='ours', log_path='nohup.out'):
     weekdays = np.array([0,1,2,3,4,8,9,10,11])
     weekday_indices = (np.repeat(weekdays.reshape(-1, 1), 8, axis=1)*8 + np.arange(8).reshape(1, -1)).reshape(-1)
 
-    _Y_pred = np.zeros((8*14, 2404)) # (n_sample, n_road)
-    _Y_true = np.zeros((8*14, 2404))
+    _Y_pred = np.zeros((8*14, Y_pred.shape[1])) # (n_sample, n_road)
+    _Y_true = np.zeros((8*14, Y_pred.shape[1]))
     for i in range(14):
         _Y_pred[i*8:(i+1)*8] = Y_pred[(7*4-interval_offset+ToD*i):(9*4-interval_offset+ToD*i)]
         _Y_true[i*8:(i+1)*8] = Y_true[(7*4-interval_offset+ToD*i):(9*4-interval_offset+ToD*i)]
@@ -129,8 +129,8 @@ def result_analysis2(Y_pred, Y_true, model_type='ours', log_path='nohup.out'):
     rmse = RMSE(_Y_pred, _Y_true, main_roads=False)
     print_log('>> Peak hours %d-%d. MAE: %.3f, MAPE: %.3f, RMSE: %.3f'%(7, 9, mae, mape, rmse), log_path)
     
-    _Y_pred = np.zeros((8*14, 2404)) # (n_sample, n_road)
-    _Y_true = np.zeros((8*14, 2404))
+    _Y_pred = np.zeros((8*14, Y_pred.shape[1])) # (n_sample, n_road)
+    _Y_true = np.zeros((8*14, Y_pred.shape[1]))
     for i in range(14):
         _Y_pred[i*8:(i+1)*8] = Y_pred[(14*4-interval_offset+ToD*i):(16*4-interval_offset+ToD*i)]
         _Y_true[i*8:(i+1)*8] = Y_true[(14*4-interval_offset+ToD*i):(16*4-interval_offset+ToD*i)]
@@ -2,11 +2,23 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
+import scipy.sparse as sp
 from utils import to_sparse_tensor
 
 
 def normalize_adj(adj, mode='random walk'):
     # mode: 'random walk', 'aggregation'
+    # adj: np.array, or scipy.sparse matrix (normalized as sparse)
+    if sp.issparse(adj):
+        if mode == 'random walk': # for T. avg weight for sending node
+            deg = np.asarray(adj.sum(axis=1)).reshape(-1).astype(np.float32)
+            inv_deg = np.reciprocal(deg, out=np.zeros_like(deg), where=deg!=0)
+            normalized_adj = sp.diags(inv_deg).dot(adj).tocsr()
+        if mode == 'aggregation': # for W. avg weight for receiving node
+            deg = np.asarray(adj.sum(axis=0)).reshape(-1).astype(np.float32)
+            inv_deg = np.reciprocal(deg, out=np.zeros_like(deg), where=deg!=0)
+            normalized_adj = adj.dot(sp.diags(inv_deg)).tocsr()
+        return normalized_adj
     if mode == 'random walk': # for T. avg weight for sending node
         deg = np.sum(adj, axis=1).astype(np.float32)
         inv_deg = np.reciprocal(deg, out=np.zeros_like(deg), where=deg!=0)
@@ -20,25 +32,56 @@ def normalize_adj(adj, mode='random walk'):
     return normalized_adj
 
 
-def graph_propagation_sparse(x, A, hop=10, dual=False):
-    # sparse version
-    # x: graph signal vector. tensor. (n_road)
+def graph_propagation(X, A, hop=10, dual=False):
+    # batched version: k graph signals propagated together, with one sparse matmul per hop (two if dual)
+    # X: graph signals. tensor. (n_road, k)
     # A: adjacency matrix. tranposed. sparse_tensor. (n_road, n_road)
     # hop: # propagation steps
-    # output: propagation result. tensor. (n_road, hop+1)
+    # output: propagation result. tensor. (n_road, k, hop+1), or (n_road, k, 2**(hop+1)-1) if dual.
+    #   dual: columns of each signal in tree order, as [x, A X', A^T X'] with X' the columns of the previous hop
     
-    y = x.unsqueeze(1)
-    X = y
+    n_road, k = X.shape
     if dual: # dual random walk
+        A_T = A.transpose(0, 1).coalesce() # once for all hops
+        out = X.new_zeros(n_road, k, 2**(hop+1)-1)
+        out[:, :, 0] = X
+        width = 1 # columns of the previous hop
         for i in range(hop):
-            y_down = A.mm(X) # downstream
-            y_up = A.transpose(0, 1).mm(X) # upstream
-            X = torch.cat([y, y_down, y_up], dim=1)
+            X_prev = out[:, :, :width].contiguous().view(n_road, k * width)
+            y_down = A.mm(X_prev).view(n_road, k, width) # downstream
+            y_up = A_T.mm(X_prev).view(n_road, k, width) # upstream
+            out[:, :, 1:width+1] = y_down
+            out[:, :, width+1:2*width+1] = y_up
+            width = 2 * width + 1
     else: # downstream random walk only
+        out = X.new_zeros(n_road, k, hop+1)
+        out[:, :, 0] = X
+        y = X
         for i in range(hop):
             y = A.mm(y)
-            X = torch.cat([X, y], dim=1)
-    return X
+            out[:, :, i+1] = y
+    return out
+
+
+def graph_propagation_sparse(x, A, hop=10, dual=False):
+    # sparse version
+    # x: graph signal vector. tensor. (n_road)
+    # A: adjacency matrix. tranposed. sparse_tensor. (n_road, n_road)
+    # hop: # propagation steps
+    # output: propagation result. tensor. (n_road, hop+1)
+    return graph_propagation(x.unsqueeze(1), A, hop=hop, dual=dual)[:, 0, :]
+
+
+def block_diagonal(matrices, transpose=False):
+    # sparse block-diagonal matrix of k sparse (n_road, n_road) tensors, each transposed if transpose. sparse_tensor. (k*n_road, k*n_road)
+    # propagating the stacked signals (k*n_road, 1) through it propagates signal i through matrix i, in one sparse matmul.
+    n_road = matrices[0].shape[0]
+    indices, values = [], []
+    for i, A in enumerate(matrices):
+        index = A._indices()
+        indices.append((index[[1, 0]] if transpose else index) + i * n_road)
+        values.append(A._values())
+    return torch.sparse_coo_tensor(torch.cat(indices, dim=1), torch.cat(values), (len(matrices) * n_road, len(matrices) * n_road)).coalesce()
 
 
 from torch.nn import Parameter
@@ -111,19 +154,20 @@ class ChannelAttention(nn.Module):
 class Model_TrGNN(nn.Module):
     # TrGNN.
     
-    def __init__(self, input_size=1, output_size=1, demand_hop=75, status_hop=3):
+    def __init__(self, input_size=1, output_size=1, demand_hop=75, status_hop=3, n_road=2404):
         super(Model_TrGNN, self).__init__()
         
+        self.n_road = n_road
         self.input_size = input_size
         self.output_size = output_size
         self.demand_hop = demand_hop
         self.status_hop = status_hop
         
         # attention
-        self.attention_layer = ChannelAttention(2**(status_hop+1)-1, demand_hop+1, channels=2404, bias=True) # channels=n_road
+        self.attention_layer = ChannelAttention(2**(status_hop+1)-1, demand_hop+1, channels=n_road, bias=True)
                 
         # linear output
-        self.output_layer = ChannelFullyConnected(in_features=4+24+1, channels=2404) # channels=n_road
+        self.output_layer = ChannelFullyConnected(in_features=4+24+1, channels=n_road)
         
 
     def forward(self, X, T, W, h_init, W_norm, ToD, DoW):
@@ -134,11 +178,23 @@ class Model_TrGNN(nn.Module):
         # ToD: road-wise one-hot encoding of hour of day. (n_road, 24)
         # DoW: road-wise indicator. 1 for weekdays, 0 for weekends/PHs. (n_road, 1)
         
-        # graph propagation
-        H = torch.cat([graph_propagation_sparse(x, A.transpose(0, 1), hop=self.demand_hop).unsqueeze(0) for x, A in zip(torch.unbind(X, dim=0), T)], dim=0)
+        H, S = self.propagate(X, T, W_norm)
+        return self.predict(H, S, ToD, DoW)
 
+    def propagate(self, X, T, W_norm):
+        # graph propagation. no learnable parameters, so the output can be cached (see feature_cache.py).
+        # X: (n_step, n_road). T: tuple of n_step sparse_tensors. output: (H, S)
+        # all history steps at once: step i through transposed T[i], as one block-diagonal matrix
+        H = graph_propagation(X.contiguous().view(-1, 1), block_diagonal(T, transpose=True), hop=self.demand_hop).view(X.shape[0], X.shape[1], -1)
+        S = graph_propagation(X.transpose(0, 1), W_norm, hop=self.status_hop, dual=True).permute(1, 0, 2) # (history_window, n_road, 2**(status_hop+1)-1)
+        return H, S
+
+    def predict(self, H, S, ToD, DoW):
+        # H: demand propagation. (history_window, n_road, demand_hop+1)
+        # S: status propagation. (history_window, n_road, 2**(status_hop+1)-1)
+        # ToD, DoW: as in forward
+        
         # attention
-        S = torch.cat([graph_propagation_sparse(x, W_norm, hop=self.status_hop, dual=True).unsqueeze(0) for x in torch.unbind(X, dim=0)], dim=0)
         att = self.attention_layer(S.unsqueeze(3)) # specify weights and bias for each road segment
         att = F.softmax(att, dim=2) # attention weights across hops sum up to 1. (history_window, n_road, demand_hop+1)
         H = torch.mul(H, att) # (history_window, n_road, demand_hop+1)
@@ -156,19 +212,20 @@ class Model_TrGNN(nn.Module):
 class Model_GNN(nn.Module):
     # TrGNN-. Remove trajectory information. Replace T in TrGNN with W_norm.
     
-    def __init__(self, input_size=1, output_size=1, demand_hop=75, status_hop=3):
+    def __init__(self, input_size=1, output_size=1, demand_hop=75, status_hop=3, n_road=2404):
         super(Model_GNN, self).__init__()
         
+        self.n_road = n_road
         self.input_size = input_size
         self.output_size = output_size
         self.demand_hop = demand_hop
         self.status_hop = status_hop
         
         # attention
-        self.attention_layer = ChannelAttention(2**(status_hop+1)-1, demand_hop+1, channels=2404, bias=True) # channels=n_road
+        self.attention_layer = ChannelAttention(2**(status_hop+1)-1, demand_hop+1, channels=n_road, bias=True)
                 
         # linear output
-        self.output_layer = ChannelFullyConnected(in_features=4+24+1, channels=2404) # channels=n_road
+        self.output_layer = ChannelFullyConnected(in_features=4+24+1, channels=n_road)
         
 
     def forward(self, X, T, W, h_init, W_norm, ToD, DoW):
@@ -179,11 +236,22 @@ class Model_GNN(nn.Module):
         # ToD: road-wise one-hot encoding of hour of day. (n_road, 24)
         # DoW: road-wise indicator. 1 for weekdays, 0 for weekends/PHs. (n_road, 1)
         
-        # graph propagation
-        H = torch.cat([graph_propagation_sparse(x, W_norm, hop=self.demand_hop).unsqueeze(0) for x in torch.unbind(X, dim=0)], dim=0)
+        H, S = self.propagate(X, T, W_norm)
+        return self.predict(H, S, ToD, DoW)
 
+    def propagate(self, X, T, W_norm):
+        # graph propagation. no learnable parameters, so the output can be cached (see feature_cache.py).
+        # X: (n_step, n_road). T: tuple of n_step sparse_tensors. output: (H, S)
+        H = graph_propagation(X.transpose(0, 1), W_norm, hop=self.demand_hop).permute(1, 0, 2) # (history_window, n_road, demand_hop+1)
+        S = graph_propagation(X.transpose(0, 1), W_norm, hop=self.status_hop, dual=True).permute(1, 0, 2) # (history_window, n_road, 2**(status_hop+1)-1)
+        return H, S
+
+    def predict(self, H, S, ToD, DoW):
+        # H: demand propagation. (history_window, n_road, demand_hop+1)
+        # S: status propagation. (history_window, n_road, 2**(status_hop+1)-1)
+        # ToD, DoW: as in forward
+        
         # attention
-        S = torch.cat([graph_propagation_sparse(x, W_norm, hop=self.status_hop, dual=True).unsqueeze(0) for x in torch.unbind(X, dim=0)], dim=0)
         att = self.attention_layer(S.unsqueeze(3)) # specify weights and bias for each road segment
         att = F.softmax(att, dim=2) # attention weights across hops sum up to 1. (history_window, n_road, demand_hop+1)
         H = torch.mul(H, att) # (history_window, n_road, demand_hop+1)
@@ -0,0 +1,120 @@
+# nohup python postprocess.py -d1 20160314 -d2 20160314 -i 5,15 >> log/postprocess0314.log &
+import os
+import time
+import argparse
+import numpy as np
+import pandas as pd
+from multiprocessing import Pool
+from utils import date_range, date_timestamp, peak_memory
+from road_graph import get_road_list
+from trajectory_store import read_recovered_trajectory
+from flow import aggregate_flow, coarsen_flow, flow_csv_paths, save_flows
+from flow_store import flow_store_path, write_flow_day
+from trajectory_transition import count_moves, save_transition, transition_path
+
+
+# Post-processing of recovered trajectories in a single pass per date, emitting together:
+#   flow (as flow.py), trajectory transition (as trajectory_transition.py) and trajectory metadata.
+# Trajectory metadata: data/trajectory_metadata.csv, one row per date (date, vehicles, trajectories), used for flow calibration.
+METADATA_PATH = 'data/trajectory_metadata.csv'
+
+
+def scan_trajectory(vehicle_index, trajectory_ids, road_index):
+    # Compare consecutive points once, for both flow and transitions.
+    # inputs: arrays of recovered trajectory points, sorted by (vehicle, trajectory, time)
+    # output: (new_vehicle, new_trajectory, road_change), bool arrays. Each is True at the first point.
+    new_vehicle = np.ones(len(road_index), dtype=bool)
+    new_vehicle[1:] = vehicle_index[1:] != vehicle_index[:-1]
+    new_trajectory = new_vehicle.copy()
+    new_trajectory[1:] |= trajectory_ids[1:] != trajectory_ids[:-1]
+    road_change = np.ones(len(road_index), dtype=bool)
+    road_change[1:] = road_index[1:] != road_index[:-1]
+    return new_vehicle, new_trajectory, road_change
+
+
+def count_trajectories(vehicle_index, trajectory_ids):
+    # output: (vehicles, trajectories), numbers of distinct vehicles and of distinct (vehicle, trajectory).
+    # Counted over the whole day, as rows of a vehicle are not contiguous in a store extracted in chunks (trajectory.py -M).
+    pairs = np.unique(np.stack([vehicle_index, trajectory_ids], axis=1), axis=0)
+    return len(np.unique(pairs[:, 0])), len(pairs)
+
+
+def postprocess_day(day_args):
+    # Worker: flow, trajectory transition and metadata of one date. Flow and transition files are saved.
+    # output: (date, flow at the finest interval, metadata row)
+    current_date, intervals, transition_interval, road_list = day_args
+    start_time = time.time()
+    n_roads = len(road_list)
+    trajectory = read_recovered_trajectory(current_date, current_date, road_list, columns=['vehicle_index', 'trajectory_id', 'timestamp', 'road_index'])
+    _, new_trajectory, road_change = scan_trajectory(trajectory['vehicle_index'], trajectory['trajectory_id'], trajectory['road_index'])
+
+    # flow: entry of a vehicle into a road segment
+    slots = (trajectory['timestamp'] - date_timestamp(current_date)) // (intervals[0] * 60)
+    flow = aggregate_flow(slots, trajectory['road_index'], new_trajectory | road_change, 24 * 60 // intervals[0], n_roads)
+    save_flows(flow, intervals, flow_csv_paths(current_date, current_date, intervals), current_date, current_date, road_list['road_id'].values)
+
+    # trajectory transition: move to another road segment within a trajectory
+    shape = (60//transition_interval*24, n_roads, n_roads)
+    trajectory_transition = count_moves(~new_trajectory[1:] & road_change[1:], trajectory['road_index'], trajectory['timestamp'], shape, interval=transition_interval)
+    save_transition(transition_path(current_date, current_date, interval=transition_interval), trajectory_transition)
+
+    vehicles, trajectories = count_trajectories(trajectory['vehicle_index'], trajectory['trajectory_id'])
+    metadata = {'date': current_date, 'vehicles': vehicles, 'trajectories': trajectories}
+    print('Date %s: %d points processed in %.2f seconds'%(current_date, len(trajectory['road_index']), time.time() - start_time))
+    return current_date, flow, metadata
+
+
+def read_trajectory_metadata(start_date=None, end_date=None, in_path=METADATA_PATH):
+    # Rows of trajectory metadata from start_date to end_date, in date order
+    trajectory_metadata = pd.read_csv(in_path, dtype={'date': str})
+    if start_date is not None:
+        trajectory_metadata = trajectory_metadata[(trajectory_metadata['date'] >= start_date) & (trajectory_metadata['date'] <= end_date)]
+    return trajectory_metadata.sort_values('date').reset_index(drop=True)
+
+
+def update_trajectory_metadata(rows, out_path=METADATA_PATH):
+    # Add or replace the rows of dates in trajectory metadata
+    trajectory_metadata = pd.DataFrame(rows, columns=['date', 'vehicles', 'trajectories'])
+    if os.path.exists(out_path):
+        existing_metadata = read_trajectory_metadata(in_path=out_path)
+        existing_metadata = existing_metadata[~existing_metadata['date'].isin(trajectory_metadata['date'])]
+        trajectory_metadata = pd.concat([existing_metadata, trajectory_metadata])
+    trajectory_metadata.sort_values('date').to_csv(out_path, index=False)
+
+
+if __name__ == '__main__':
+
+    # Arguments
+    parser = argparse.ArgumentParser(description='postprocess')
+    parser.add_argument('-d1', '--start_date', help='%Y%m%d', required=True)
+    parser.add_argument('-d2', '--end_date', help='%Y%m%d', required=True)
+    parser.add_argument('-i', '--interval', help='flow intervals in minutes, separated by comma, e.g. 5,15,60', default='5,15')
+    parser.add_argument('-I', '--transition_interval', help='trajectory transition interval in minutes. should divide 60', default=15)
+    parser.add_argument('-j', '--num_workers', help='number of worker processes', default=1)
+    args = parser.parse_args()
+    start_date, end_date, transition_interval, num_workers = args.start_date, args.end_date, int(args.transition_interval), int(args.num_workers)
+    intervals = sorted(set(int(interval) for interval in str(args.interval).split(',')))
+    for interval in intervals:
+        if interval % intervals[0] != 0 or (24 * 60) % interval != 0:
+            parser.error('intervals should divide a day, and be multiples of the finest interval %d'%(intervals[0]))
+
+    print('Reading road list')
+    road_list = get_road_list(road_df=None, out_path='data/road_list.csv', update=False)
+    date_list = date_range(start_date, end_date)
+    day_args = [(current_date, intervals, transition_interval, road_list) for current_date in date_list]
+    pool = Pool(num_workers) if num_workers > 1 and len(date_list) > 1 else None
+
+    # dates are processed by workers. flow store and metadata are written here only, as each date finishes.
+    start_time = time.time()
+    rows = []
+    for current_date, flow, metadata in (pool.imap(postprocess_day, day_args) if pool is not None else map(postprocess_day, day_args)):
+        for interval in intervals:
+            write_flow_day(flow_store_path(interval), current_date, coarsen_flow(flow, interval // intervals[0]), road_list['road_id'].values, interval=interval)
+        update_trajectory_metadata([metadata])
+        rows.append(metadata)
+        print('Date %s finished (%d/%d). Vehicles: %d. Trajectories: %d. Total flow: %d. Time spent: %.2f seconds. Peak memory: %.1f MB'%(
+            current_date, len(rows), len(date_list), metadata['vehicles'], metadata['trajectories'], flow.sum(), time.time() - start_time, peak_memory()))
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print('Saved trajectory metadata of %d dates at %s'%(len(rows), METADATA_PATH))
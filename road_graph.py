@@ -2,8 +2,11 @@ import os
 import pandas as pd
 import networkx as nx
 import pickle as pkl
+import hashlib
 from math import radians, degrees, sin, cos, asin, acos, sqrt
 import numpy as np
+import scipy.sparse as sp
+from graph_store import graph_store_path, graph_store_current, write_graph_store, read_graph_store, store_edges
 
 
 # Parameter Settings
@@ -19,21 +22,73 @@ def great_circle(lon1, lat1, lon2, lat2):
     return 6371 * ( acos(sin(lat1) * sin(lat2) + cos(lat1) * cos(lat2) * cos(lon1 - lon2)) )
 
 
+def haversine(lon1, lat1, lon2, lat2):
+    # great circle distance in km, by the haversine formula. Vectorized over arrays of coordinates in degrees.
+    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371 * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+class RoadGrid():
+    # Spatial grid index of road segments, by the grid cell of their start point.
+    # Segments of a bounding box are looked up in the rows of cells it overlaps, then checked on both end points.
+
+    def __init__(self, road_df, cell_size=0.005):
+        # road_df: with numeric start_lat, start_lon, end_lat, end_lon. cell_size: in degrees
+        self.coordinates = {column: road_df[column].values.astype(np.float64) for column in ['start_lat', 'start_lon', 'end_lat', 'end_lon']}
+        located = np.flatnonzero(~np.isnan(np.column_stack(list(self.coordinates.values()))).any(axis=1))
+        self.cell_size = cell_size
+        self.min_lat = self.coordinates['start_lat'][located].min() if len(located) > 0 else 0.
+        self.min_lon = self.coordinates['start_lon'][located].min() if len(located) > 0 else 0.
+        rows, columns = self.cell(self.coordinates['start_lat'][located], self.coordinates['start_lon'][located])
+        self.n_columns = columns.max() + 1 if len(located) > 0 else 1
+        cells = rows * self.n_columns + columns
+        order = np.argsort(cells, kind='mergesort')
+        self.cells, self.positions = cells[order], located[order] # positions in road_df, grouped by cell
+
+    def cell(self, lats, lons):
+        # output: (row, column) of the grid cells of points
+        return (np.floor((lats - self.min_lat) / self.cell_size).astype(np.int64), 
+                np.floor((lons - self.min_lon) / self.cell_size).astype(np.int64))
+
+    def query(self, boundary):
+        # boundary: [min_lat, max_lat, min_lon, max_lon]
+        # output: ascending positions in road_df of the segments with both end points within boundary
+        min_lat, max_lat, min_lon, max_lon = boundary
+        (min_row, max_row), (min_column, max_column) = self.cell(np.array([min_lat, max_lat]), np.array([min_lon, max_lon]))
+        min_column, max_column = max(min_column, 0), min(max_column, self.n_columns - 1)
+        if min_column > max_column:
+            return np.array([], dtype=np.int64)
+        candidates = []
+        for row in range(max(min_row, 0), max_row + 1):
+            start, end = np.searchsorted(self.cells, [row * self.n_columns + min_column, row * self.n_columns + max_column + 1])
+            candidates.append(self.positions[start:end])
+        candidates = np.sort(np.concatenate(candidates)) if len(candidates) > 0 else np.array([], dtype=np.int64)
+        within = np.ones(len(candidates), dtype=bool)
+        for column, (lower, upper) in [('start_lat', (min_lat, max_lat)), ('end_lat', (min_lat, max_lat)), 
+                                       ('start_lon', (min_lon, max_lon)), ('end_lon', (min_lon, max_lon))]:
+            values = self.coordinates[column][candidates]
+            within &= (values >= lower) & (values <= upper)
+        return candidates[within]
+
+
+def cut_region(road_df, boundary, grid=None):
+    # Road segments with both end points within boundary, in the order of road_df.
+    # boundary: [min_lat, max_lat, min_lon, max_lon]. grid: None, or RoadGrid of road_df, to cut several regions
+    grid = RoadGrid(road_df) if grid is None else grid
+    return road_df.iloc[grid.query(boundary)]
+
+
 def read_road_dataset(boundary=None, road_path='data/LTA_cleaned.txt'):
     # boundary: None, or [min_lat, max_lat, min_lon, max_lon]. If None, return full road dataset.
+    # Coordinates are numeric columns (start_lat, start_lon, end_lat, end_lon). length: in km
     column_names = ['road_id', 'road_type','lane_id',
                     'zone_id','road_name', 'vertex_num', 
                     'start_lon', 'start_lat', 'end_lon', 'end_lat']
     road_df = pd.read_csv(road_path, header=None, names=column_names)
+    road_df['length'] = haversine(road_df['start_lon'].values, road_df['start_lat'].values, road_df['end_lon'].values, road_df['end_lat'].values)
     if boundary is not None:
-        min_lat, max_lat, min_lon, max_lon = boundary
-        road_df = road_df[(road_df['start_lat']>=min_lat) & (road_df['start_lat']<=max_lat) & 
-                 (road_df['end_lat']>=min_lat) & (road_df['end_lat']<=max_lat) & 
-                 (road_df['start_lon']>=min_lon) & (road_df['start_lon']<=max_lon) & 
-                 (road_df['end_lon']>=min_lon) & (road_df['end_lon']<=max_lon)]
-    road_df['start'] = road_df.apply(lambda row: (row['start_lat'], row['start_lon']), axis=1)
-    road_df['end'] = road_df.apply(lambda row: (row['end_lat'], row['end_lon']), axis=1)
-    road_df['length'] = road_df.apply(lambda row: great_circle(row['start_lon'], row['start_lat'], row['end_lon'], row['end_lat']), axis=1)
+        road_df = cut_region(road_df, boundary)
     return road_df
 
 
@@ -49,11 +104,20 @@ def get_road_list(road_df=None, out_path='data/road_list.csv', update=False):
     return road_list
 
 
+def road_graph_store(graph_path='data/road_graph.gml'):
+    # Binary CSR store of the road graph (see graph_store.py), imported from the GML file if missing or older than it
+    store_path = graph_store_path(graph_path)
+    if not graph_store_current(store_path, graph_path):
+        print('Importing graph store from %s'%(graph_path))
+        write_graph_store(nx.relabel_nodes(nx.read_gml(graph_path), int), store_path)
+    return read_graph_store(store_path)
+
+
 def road_graph(road_df=None, out_path='data/road_graph.gml', update=False):
-    if not update and os.path.exists(out_path):
+    # output: the memory-mapped graph store (see graph_store.py). out_path: GML file, kept as import/export format.
+    # Code that needs networkx (e.g. shortest paths) converts it with graph_store.to_networkx().
+    if not update and (os.path.exists(out_path) or graph_store_current(graph_store_path(out_path), out_path)):
         print('Graph exists')
-        G = nx.read_gml(out_path)
-        G = nx.relabel_nodes(G, int)
     else:
         print('Generating new graph from road df')
         G = nx.DiGraph()
@@ -63,63 +127,85 @@ def road_graph(road_df=None, out_path='data/road_graph.gml', update=False):
         lengths = dict(zip(road_df['road_id'], road_df['length']))
         nx.set_node_attributes(G, lengths, 'length')
 
-        road_df = road_df.copy()
-        road_df = road_df[['road_id', 'start', 'end', 'length']]
-        road_df['key'] = 0
-        adj_df = road_df.merge(road_df, on='key', how='inner')
-        adj_df = adj_df[((adj_df['end_x'] == adj_df['start_y']) & (adj_df['start_x'] != adj_df['end_y'])) # x -> y
-                        | (adj_df['road_id_x'] == adj_df['road_id_y'])]  # x self
-        adj_df['distance'] = adj_df.apply(lambda row: 
-                                          (row['length_x'] + row['length_y']) / 2 if row['road_id_x'] != row['road_id_y'] 
-                                          else 0, axis=1)
-        adj_df['edge'] = adj_df.apply(lambda row: (row['road_id_x'], row['road_id_y'], {'weight': row['distance']}), axis=1)
-        edge_list = list(adj_df['edge'])
+        # x -> y if x ends where y starts (and y does not lead back to the start of x), plus self loops.
+        # Found by hash joins on coordinates and road_id, rather than a cross join of all pairs.
+        road_df = road_df[['road_id', 'start_lat', 'start_lon', 'end_lat', 'end_lon', 'length']].reset_index(drop=True)
+        road_df['position'] = np.arange(len(road_df))
+        adj_df = road_df.dropna(subset=['end_lat', 'end_lon']).merge(road_df.dropna(subset=['start_lat', 'start_lon']), # missing coordinates never match
+                                                                     left_on=['end_lat', 'end_lon'], right_on=['start_lat', 'start_lon'], suffixes=('_x', '_y'))
+        adj_df = adj_df[(adj_df['start_lat_x'] != adj_df['end_lat_y']) | (adj_df['start_lon_x'] != adj_df['end_lon_y'])] # x -> y
+        self_df = road_df.merge(road_df, on='road_id', suffixes=('_x', '_y')) # x self
+        self_df['road_id_x'] = self_df['road_id_y'] = self_df['road_id']
+        columns = ['position_x', 'position_y', 'road_id_x', 'road_id_y', 'length_x', 'length_y']
+        adj_df = pd.concat([adj_df[columns], self_df[columns]]).drop_duplicates(subset=['position_x', 'position_y'])
+        adj_df = adj_df.iloc[np.lexsort((adj_df['position_y'].values, adj_df['position_x'].values))] # edge order of the cross join
+        distances = np.where(adj_df['road_id_x'].values != adj_df['road_id_y'].values, (adj_df['length_x'].values + adj_df['length_y'].values) / 2, 0)
+        edge_list = [(road_id_x, road_id_y, {'weight': distance}) 
+                     for road_id_x, road_id_y, distance in zip(adj_df['road_id_x'].values.tolist(), adj_df['road_id_y'].values.tolist(), distances.tolist())]
         G.add_edges_from(edge_list)
         
         nx.write_gml(G, out_path)
+        write_graph_store(G, graph_store_path(out_path))
         
-    return G
+    return road_graph_store(out_path)
+
+
+def road_index_lookup(road_list):
+    # road_id -> road index (position in road_list), as a hashed pd.Series
+    return pd.Series(np.arange(len(road_list)), index=road_list['road_id'].values)
+
+
+def graph_edges(G):
+    # output: (origins, destinations, weights), arrays of the edges of G
+    edges = list(G.edges(data='weight'))
+    origins = np.array([edge[0] for edge in edges], dtype=np.int64)
+    destinations = np.array([edge[1] for edge in edges], dtype=np.int64)
+    weights = np.array([edge[2] for edge in edges], dtype=np.float64)
+    return origins, destinations, weights
 
 
-def extract_road_adj(G=None, road_list=None):
+def graph_hash(road_ids, origins, destinations, weights):
+    # content hash of the road index and the weighted edges, independent of edge order
+    order = np.lexsort((destinations, origins))
+    content = hashlib.sha1()
+    for array in [np.asarray(road_ids, dtype=np.int64), origins[order], destinations[order], weights[order]]:
+        content.update(np.ascontiguousarray(array).tobytes())
+    return content.hexdigest()[:16]
+
+
+def extract_road_adj(G=None, road_list=None, dense=False):
+    # G: graph store (see road_graph()), nx.DiGraph, or None to read data/road_graph.gml's store
+    # Weighted road adjacency: road_adj[i, j] = exp(-weight of edge i -> j), with road index of road_list.
+    # Cached as data/road_adj_<content hash of graph and road_list>.npz
+    # output: scipy.sparse.csr_matrix of float32 (n_road, n_road), or np.array if dense
     
-    file_path = 'data/road_adj.pkl'
+    if road_list is None:
+        road_list = get_road_list()
+    if G is None:
+        G = road_graph_store('data/road_graph.gml')
+    if isinstance(G, dict): # edges read from the graph store, without networkx
+        origins, destinations, weights = store_edges(G)
+    else:
+        origins, destinations, weights = graph_edges(G)
+    file_path = 'data/road_adj_%s.npz'%(graph_hash(road_list['road_id'].values, origins, destinations, weights))
     if os.path.exists(file_path):
         print('Road adj exists')
-        with open(file_path, 'rb') as f:
-            road_adj = pkl.load(f)
+        road_adj = sp.load_npz(file_path)
     else:
         print('Extracting road adj from graph')
-        
-        from road_graph import road_graph
-        G = road_graph(road_df=None, out_path='data/road_graph.gml', update=False)
-        road_adj = np.zeros((len(G.nodes), len(G.nodes)), dtype=np.float32)
-        
-        from road_graph import get_road_list
-        road_list = get_road_list()
-        def road_index(road_id):
-            return road_list[road_list['road_id']==road_id].index[0]
+        road_index = road_index_lookup(road_list)
+        if not (np.all(np.isin(origins, road_index.index)) and np.all(np.isin(destinations, road_index.index))):
+            raise ValueError('road graph has road segments out of road_list')
 
         # masked exponential kernel. Set lambda = 1.
         lambda_ = 1
         # lambda: for future consideration
-        # total_weight = 0
-        # total_count = 0
-
-        # for O in list(G.nodes):
-        #     for D in list(G.successors(O)):
-        #         total_weight += G.edges[O, D]['weight']
-        #         total_count += 1
-
-        # lambda_ = total_weight / total_count
-        for O in list(G.nodes):
-            for D in list(G.successors(O)):
-                road_adj[road_index(O), road_index(D)] = lambda_ * np.exp(- lambda_ * G.edges[O, D]['weight'])
-
-        with open(file_path, 'wb') as f:
-            pkl.dump(road_adj, f)
+        # lambda_ = weights.mean()
+        road_adj = sp.csr_matrix((lambda_ * np.exp(- lambda_ * weights), (road_index.loc[origins].values, road_index.loc[destinations].values)), 
+                                 shape=(len(road_list), len(road_list)), dtype=np.float32)
+        sp.save_npz(file_path, road_adj)
     
-    return road_adj
+    return road_adj.toarray() if dense else road_adj
 
 
 if __name__ == '__main__':
@@ -0,0 +1,146 @@
+import os
+import time
+import hashlib
+import pickle as pkl
+from collections import OrderedDict
+import numpy as np
+import networkx as nx
+from road_graph import graph_edges, graph_hash
+
+
+class RoadPaths():
+    # Shortest-path service on the road graph.
+    # Single-source Dijkstra trees (optionally bounded by radius, in km) are memoized in an LRU cache,
+    # and reachability between road segments is answered from strongly-connected-component labels.
+    # Paths and lengths are identical to nx.dijkstra_path and nx.dijkstra_path_length.
+
+    def __init__(self, G, radius=None, cache_size=10000, cache_path=None):
+        # G: road graph. nx.DiGraph with edge attribute 'weight' and node attribute 'length'
+        # radius: cutoff of each Dijkstra tree, in km. None for unbounded trees.
+        # cache_size: max number of Dijkstra trees kept in memory
+        # cache_path: if not None, trees are loaded from and saved to this file
+        self.G = G
+        self.radius = radius
+        self.cache_size = cache_size
+        self.cache_path = cache_path
+        self.trees = OrderedDict() # source -> (predecessor, distance)
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0 # searches beyond radius
+        self.search_time = 0. # seconds spent in Dijkstra searches
+        self.build_reachability()
+        if cache_path is not None and os.path.exists(cache_path):
+            self.load()
+
+    def build_reachability(self):
+        # Label each node with its strongly connected component (SCC).
+        # reach[c] is a bitset of the SCCs reachable from SCC c, built in reverse topological order of the condensation.
+        sccs = list(nx.strongly_connected_components(self.G))
+        C = nx.condensation(self.G, sccs)
+        self.scc_label = C.graph['mapping']
+        reach = [0] * len(sccs)
+        for c in reversed(list(nx.topological_sort(C))):
+            bits = 1 << c
+            for successor in C.successors(c):
+                bits |= reach[successor]
+            reach[c] = bits
+        self.reach = reach
+
+    def has_path(self, O, D):
+        return (self.reach[self.scc_label[O]] >> self.scc_label[D]) & 1 == 1
+
+    def tree(self, O):
+        # Dijkstra tree from O: (first predecessor of each node on its shortest path, distance of each node)
+        if O in self.trees:
+            self.hits += 1
+            self.trees.move_to_end(O)
+            return self.trees[O]
+        self.misses += 1
+        start_time = time.time()
+        pred, dist = nx.dijkstra_predecessor_and_distance(self.G, O, cutoff=self.radius)
+        self.search_time += time.time() - start_time
+        tree = ({node: predecessors[0] for node, predecessors in pred.items() if predecessors}, dist)
+        self.trees[O] = tree
+        if len(self.trees) > self.cache_size:
+            self.trees.popitem(last=False)
+        return tree
+
+    def shortest_path_length(self, O, D):
+        pred, dist = self.tree(O)
+        if D in dist:
+            return dist[D]
+        self.fallbacks += 1
+        start_time = time.time()
+        try:
+            return nx.dijkstra_path_length(self.G, O, D) # raises nx.NetworkXNoPath if D is unreachable
+        finally:
+            self.search_time += time.time() - start_time
+
+    def shortest_path(self, O, D):
+        pred, dist = self.tree(O)
+        if D not in dist:
+            self.fallbacks += 1
+            start_time = time.time()
+            try:
+                return nx.dijkstra_path(self.G, O, D) # raises nx.NetworkXNoPath if D is unreachable
+            finally:
+                self.search_time += time.time() - start_time
+        path = [D]
+        while path[-1] != O:
+            path.append(pred[path[-1]])
+        return path[::-1]
+
+    def shortest_distance(self, O, D):
+        # distance between the midpoints of two road segments, in km
+        if O == D:
+            return 0
+        shortest_path_length = self.shortest_path_length(O, D)
+        return shortest_path_length - self.G.nodes[O]['length']/2 - self.G.nodes[D]['length']/2
+
+    def dijkstra_calls(self):
+        return self.misses + self.fallbacks
+
+    def hit_rate(self):
+        queries = self.hits + self.misses
+        return self.hits / queries if queries > 0 else 0.
+
+    def summary(self):
+        return 'Path cache: %d trees, %d hits, %d misses, hit rate %.2f%%, %d searches beyond radius'%(
+            len(self.trees), self.hits, self.misses, 100 * self.hit_rate(), self.fallbacks)
+
+    def signature(self):
+        # cached trees are only valid for the same graph and radius: same nodes, weighted edges and road lengths
+        origins, destinations, weights = graph_edges(self.G)
+        lengths = np.array([length for _, length in self.G.nodes(data='length', default=np.nan)], dtype=np.float64)
+        return (self.G.number_of_nodes(), self.G.number_of_edges(), self.radius,
+                graph_hash(list(self.G.nodes), origins, destinations, weights), hashlib.sha1(lengths.tobytes()).hexdigest()[:16])
+
+    def load(self):
+        with open(self.cache_path, 'rb') as f:
+            signature, trees = pkl.load(f)
+        if signature == self.signature():
+            print('Path cache exists')
+            self.trees = OrderedDict(list(trees.items())[-self.cache_size:])
+        else:
+            print('Path cache does not match the road graph. Ignored.')
+
+    def save(self):
+        if self.cache_path is None:
+            return
+        print('Saving path cache to %s'%(self.cache_path))
+        temp_cache_path = '%s_temp_%d'%(self.cache_path, os.getpid())
+        with open(temp_cache_path, 'wb') as f:
+            pkl.dump((self.signature(), self.trees), f)
+        os.rename(temp_cache_path, self.cache_path)
+
+
+services = {}
+
+def road_paths(G, **kwargs):
+    # Shared path service for the road graph G, created on the first call.
+    # kwargs: see RoadPaths. Ignored once the service exists.
+    service = services.get(id(G))
+    if service is None or service.G is not G:
+        service = RoadPaths(G, **kwargs)
+        services[id(G)] = service
+    return service
@@ -0,0 +1,259 @@
+# python stream_trajectory.py -f data/ParsedTaxiData_20160314.csv [-F 1] -o data/stream_trajectory_df.csv
+# python stream_trajectory.py -p 9999 -o data/stream_trajectory_df.csv
+import time
+import socket
+import argparse
+import numpy as np
+import pandas as pd
+from utils import to_timestamp
+from road_graph import get_road_list, road_graph
+from graph_store import to_networkx
+from road_path import road_paths
+
+
+# Online trajectory extraction from live GPS readings.
+# Applies the rules of trajectory.py (Scenarios 0.2, 1.1-1.4, 2.1 and 3.1) reading by reading,
+# keeping a compact state per vehicle, and emits recovered points once they are final:
+# a point is final when no later reading can drop it (Scenario 1.2 only drops points after the current stay start)
+# and its trajectory is known to have more than one point (Scenario 2.1).
+
+class VehicleState():
+
+    __slots__ = ['last_time', 'last_road', 'stay_start_time', 'trajectory_id', 'pending',
+                 'emitted_trajectory_id', 'emitted_count', 'emitted_road']
+
+    def __init__(self, trajectory_id=0):
+        self.last_time = None # last kept reading
+        self.last_road = None
+        self.stay_start_time = None # start of stay at the same road segment
+        self.trajectory_id = trajectory_id # current trajectory
+        self.pending = [] # points not emitted yet: (timestamp, road_id, trajectory_id, scenario, time)
+        self.emitted_trajectory_id = -1 # trajectory of the last emitted point
+        self.emitted_count = 0 # points emitted for that trajectory
+        self.emitted_road = None # road of the last emitted point
+
+
+class OnlineTrajectoryExtractor():
+
+    def __init__(self, G, time_gap=10, stay_duration=2, speed_limit=120, timeout=None):
+        # timeout: in minutes. state of vehicles without readings for timeout is finalized and evicted.
+        #          at least time_gap, so that a returning vehicle starts a new trajectory as in Scenario 1.1.
+        self.G = G
+        self.paths = road_paths(G)
+        self.time_gap = time_gap
+        self.stay_duration = stay_duration
+        self.speed_limit = speed_limit
+        self.timeout = max(timeout if timeout is not None else time_gap, time_gap)
+        self.vehicles = {} # vehicle_id -> VehicleState
+        self.next_trajectory_id = {} # vehicle_id -> first trajectory_id after eviction
+        self.now = None # latest timestamp seen
+        self.late_readings = 0 # readings older than the last reading of their vehicle, skipped
+
+    def process(self, readings):
+        # readings: DataFrame with columns ['vehicle_id', 'time', 'matched_road_id'] (and optionally 'timestamp').
+        # output: recovered points that became final. DataFrame: ['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario']
+        timestamps = readings['timestamp'].values if 'timestamp' in readings.columns else to_timestamp(readings['time'])
+        order = np.argsort(timestamps, kind='mergesort')
+        output = []
+        for vehicle_id, t, time_string, road_id in zip(readings['vehicle_id'].values[order], timestamps[order],
+                                                        readings['time'].values[order], readings['matched_road_id'].values[order]):
+            self.process_reading(vehicle_id, int(t), time_string, road_id, output)
+            self.now = t if self.now is None else max(self.now, t)
+        return self.to_dataframe(output)
+
+    def process_reading(self, vehicle_id, t, time_string, road_id, output):
+        state = self.vehicles.get(vehicle_id)
+        if state is None: # Scenario 0.1: for the first reading, just record
+            # a vehicle returning after eviction starts a new trajectory, as its time gap exceeds time_gap (Scenario 1.1)
+            scenario = 1.1 if vehicle_id in self.next_trajectory_id else 0.1
+            state = VehicleState(self.next_trajectory_id.get(vehicle_id, 0))
+            self.vehicles[vehicle_id] = state
+            state.last_time, state.last_road, state.stay_start_time = t, road_id, t
+            state.pending.append((t, road_id, state.trajectory_id, scenario, time_string))
+            return
+        if t <= state.last_time: # Scenario 0.2: same timing for multiple records, skip the following records
+            if t < state.last_time:
+                self.late_readings += 1
+            return
+        if state.last_road != road_id:
+            state.stay_start_time = t # update stay start time
+        scenario = np.nan
+        # Scenarios to start a new trajectory
+        if t - state.last_time > 60 * self.time_gap: # Scenario 1.1. time gap is too long
+            scenario = 1.1
+        elif t - state.stay_start_time > 60 * self.stay_duration: # Scenario 1.2. stay at the same road segment for too long
+            scenario = 1.2
+            state.pending = [point for point in state.pending if not (state.stay_start_time < point[0] < t)] # drop intermediate points
+        elif not self.paths.has_path(state.last_road, road_id): # Scenario 1.3. cannot find path between two points
+            scenario = 1.3
+        elif self.paths.shortest_distance(state.last_road, road_id) / (t - state.last_time) * 3600 > self.speed_limit: # Scenario 1.4. driver drives exceptionally fast
+            scenario = 1.4
+        if not np.isnan(scenario):
+            state.trajectory_id += 1
+        state.pending.append((t, road_id, state.trajectory_id, scenario, time_string))
+        state.last_time, state.last_road = t, road_id
+        self.emit(vehicle_id, state, output, closed=False)
+
+    def emit(self, vehicle_id, state, output, closed=False):
+        # Emit pending points that are final. closed: no more readings for this vehicle.
+        settled = len(state.pending) if closed else sum(1 for point in state.pending if point[0] <= state.stay_start_time)
+        i = 0
+        while i < settled:
+            trajectory_id = state.pending[i][2]
+            j = i
+            while j < settled and state.pending[j][2] == trajectory_id:
+                j += 1
+            count = state.emitted_count if state.emitted_trajectory_id == trajectory_id else 0
+            if count + j - i < 2: # a single point so far
+                complete = j == len(state.pending) or state.pending[j][2] != trajectory_id # no pending point of this trajectory left
+                if complete and (closed or trajectory_id < state.trajectory_id): # and no later reading can join it
+                    i = j # Scenario 2.1. Remove trajectories with single point
+                    continue
+                break
+            for point in state.pending[i:j]:
+                self.recover(vehicle_id, state, point, output)
+            i = j
+        state.pending = state.pending[i:]
+
+    def recover(self, vehicle_id, state, point, output):
+        # Scenario 3.1. apply Dijkstra's shortest path algorithm to recover intermediate points. Timing follows D time in O-D.
+        t, road_id, trajectory_id, scenario, time_string = point
+        if state.emitted_trajectory_id != trajectory_id:
+            state.emitted_trajectory_id, state.emitted_count = trajectory_id, 0
+            output.append((vehicle_id, trajectory_id, time_string, road_id, scenario))
+        elif state.emitted_road == road_id:
+            output.append((vehicle_id, trajectory_id, time_string, road_id, scenario))
+        else:
+            for recovered_road_id in self.paths.shortest_path(state.emitted_road, road_id)[1:]: # add intermediate points and end points
+                output.append((vehicle_id, trajectory_id, time_string, recovered_road_id, 3.1))
+        state.emitted_count += 1
+        state.emitted_road = road_id
+
+    def evict(self, now=None):
+        # Finalize and evict vehicles without readings for timeout. now: timestamp. latest reading time by default.
+        now = self.now if now is None else now
+        output = []
+        if now is None:
+            return self.to_dataframe(output)
+        for vehicle_id in [vehicle_id for vehicle_id, state in self.vehicles.items() if now - state.last_time > 60 * self.timeout]:
+            self.finalize(vehicle_id, output)
+        return self.to_dataframe(output)
+
+    def flush(self):
+        # Finalize and evict all vehicles. E.g. at the end of a stream.
+        output = []
+        for vehicle_id in list(self.vehicles):
+            self.finalize(vehicle_id, output)
+        return self.to_dataframe(output)
+
+    def finalize(self, vehicle_id, output):
+        state = self.vehicles.pop(vehicle_id)
+        self.emit(vehicle_id, state, output, closed=True)
+        self.next_trajectory_id[vehicle_id] = state.trajectory_id + 1
+
+    def to_dataframe(self, output):
+        return pd.DataFrame(output, columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
+
+
+def tail_file(file_path, batch_size=1000, poll_interval=1, follow=True):
+    # Micro-batches of readings appended to a CSV file with header vehicle_id,time,matched_road_id.
+    # follow: keep waiting for new lines at the end of file. Otherwise stop at the end of file.
+    with open(file_path, 'r') as f:
+        header = f.readline().strip().split(',')
+        lines = []
+        buffer = ''
+        while True:
+            line = f.readline()
+            if line:
+                buffer += line
+                if not buffer.endswith('\n'): # incomplete line, wait for the rest
+                    continue
+                lines.append(buffer.strip().split(','))
+                buffer = ''
+                if len(lines) < batch_size:
+                    continue
+            elif follow and len(lines) == 0:
+                time.sleep(poll_interval)
+                continue
+            if len(lines) > 0:
+                yield readings_dataframe(lines, header)
+                lines = []
+            if not line and not follow:
+                break
+
+
+def socket_lines(port, batch_size=1000, timeout=1):
+    # Micro-batches of readings sent as CSV lines vehicle_id,time,matched_road_id to a local TCP port.
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(1)
+    print('Listening on port %d'%(port))
+    connection, _ = server.accept()
+    connection.settimeout(timeout)
+    buffer = ''
+    lines = []
+    while True:
+        try:
+            data = connection.recv(65536).decode()
+            if not data: # connection closed
+                break
+            buffer += data
+            *complete, buffer = buffer.split('\n')
+            lines += [line.strip().split(',') for line in complete if line.strip() != '']
+        except socket.timeout:
+            pass
+        if len(lines) >= batch_size or (len(lines) > 0 and buffer == ''):
+            yield readings_dataframe(lines, ['vehicle_id', 'time', 'matched_road_id'])
+            lines = []
+    if len(lines) > 0:
+        yield readings_dataframe(lines, ['vehicle_id', 'time', 'matched_road_id'])
+    connection.close()
+    server.close()
+
+
+def readings_dataframe(lines, header):
+    readings = pd.DataFrame(lines, columns=header)[['vehicle_id', 'time', 'matched_road_id']]
+    readings['matched_road_id'] = readings['matched_road_id'].astype(np.int64)
+    return readings
+
+
+if __name__ == '__main__':
+
+    # Arguments
+    parser = argparse.ArgumentParser(description='stream_trajectory')
+    parser.add_argument('-f', '--file', help='GPS file to tail. E.g. data/ParsedTaxiData_20160314.csv', default='')
+    parser.add_argument('-F', '--follow', help='1: keep waiting for new readings at the end of file', default=1)
+    parser.add_argument('-p', '--port', help='local TCP port to receive readings, if no file', default=9999)
+    parser.add_argument('-b', '--batch_size', help='readings per micro-batch', default=1000)
+    parser.add_argument('-o', '--out_path', default='data/stream_trajectory_df.csv')
+    args = parser.parse_args()
+    file_path, follow, port, batch_size, out_path = args.file, bool(int(args.follow)), int(args.port), int(args.batch_size), args.out_path
+
+    # Parameter Settings
+    time_gap = 10 # threshold for trajectory extraction
+    stay_duration = 2 # threshold for trajectory extraction
+    speed_limit = 120 # threshold for trajectory extraction
+    road_list_path = 'data/road_list.csv'
+    graph_path = 'data/road_graph.gml'
+
+    road_list = get_road_list(road_df=None, out_path=road_list_path, update=False)
+    G = to_networkx(road_graph(road_df=None, out_path=graph_path, update=False)) # shortest paths need networkx
+    extractor = OnlineTrajectoryExtractor(G, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit)
+    source = tail_file(file_path, batch_size=batch_size, follow=follow) if file_path != '' else socket_lines(port, batch_size=batch_size)
+
+    # Recovered points are appended to out_path as soon as they are final
+    print('Extracting trajectories to %s'%(out_path))
+    extractor.to_dataframe([]).to_csv(out_path, index=False) # save header to file
+    start_time = time.time()
+    n_readings, n_points = 0, 0
+    for readings in source:
+        readings = readings[readings['matched_road_id'].isin(road_list['road_id'])] # GPS within selected region
+        recovered_trajectory_df = pd.concat([extractor.process(readings), extractor.evict()], ignore_index=True)
+        recovered_trajectory_df.to_csv(out_path, mode='a', index=False, header=False)
+        n_readings += len(readings)
+        n_points += len(recovered_trajectory_df)
+        print('%d readings, %d points, %d active vehicles. Time spent: %s s'%(n_readings, n_points, len(extractor.vehicles), int(time.time() - start_time)))
+    recovered_trajectory_df = extractor.flush()
+    recovered_trajectory_df.to_csv(out_path, mode='a', index=False, header=False)
+    print('Finished. %d points. Total time spent: %.2f s'%(n_points + len(recovered_trajectory_df), time.time() - start_time))
@@ -0,0 +1,35 @@
+import os
+import numpy as np
+import pandas as pd
+from utils import date_timestamp
+from trajectory_store import trajectory_store_path, write_trajectory_store
+from postprocess import count_trajectories, postprocess_day
+
+
+def chunked_store(road_list, date='20160314'):
+    # Store as extracted in chunks: rows of vehicles A and B alternate between chunks
+    start = date_timestamp(date)
+    rows = [('A', 0, 60, 0), ('A', 0, 120, 1), ('B', 0, 60, 2), # chunk 1
+            ('A', 0, 1000, 1), ('A', 1, 5000, 2), ('B', 0, 1000, 0), # chunk 2
+            ('A', 1, 6000, 0), ('C', 0, 6000, 1)] # chunk 3
+    os.makedirs('data')
+    columns = {'vehicle_id': np.array([row[0] for row in rows]),
+               'trajectory_id': np.array([row[1] for row in rows], dtype=np.int32),
+               'timestamp': np.array([start + row[2] for row in rows], dtype=np.int64),
+               'road_id': road_list['road_id'].values[[row[3] for row in rows]].astype(np.int64),
+               'scenario': np.full(len(rows), 1.1, dtype=np.float32)}
+    write_trajectory_store(columns, trajectory_store_path(date, date), road_list)
+
+
+def test_count_trajectories_interleaved():
+    vehicles, trajectories = count_trajectories(np.array([0, 0, 1, 0, 0, 1, 0, 2]), np.array([0, 0, 0, 0, 1, 0, 1, 0]))
+    assert (vehicles, trajectories) == (3, 4)
+
+
+def test_postprocess_day_chunked_store(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    road_list = pd.DataFrame({'road_id': [103000001, 103000002, 103000003]})
+    chunked_store(road_list)
+    current_date, flow, metadata = postprocess_day(('20160314', [15], 15, road_list))
+    assert metadata == {'date': '20160314', 'vehicles': 3, 'trajectories': 4}
+    assert flow.shape == (96, 3)
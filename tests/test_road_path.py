@@ -0,0 +1,24 @@
+import networkx as nx
+from road_path import RoadPaths
+
+
+def small_graph(weight=1.0, length=0.1):
+    G = nx.DiGraph()
+    G.add_nodes_from((road_id, {'length': length}) for road_id in [1, 2, 3])
+    G.add_weighted_edges_from([(1, 2, weight), (2, 3, 1.0), (1, 3, 1.5)])
+    return G
+
+
+def cached_trees(G, cache_path):
+    return len(RoadPaths(G, cache_path=cache_path).trees)
+
+
+def test_path_cache_requires_same_weights_and_lengths(tmp_path):
+    cache_path = str(tmp_path / 'road_paths.pkl')
+    paths = RoadPaths(small_graph(), cache_path=cache_path)
+    assert paths.shortest_path(1, 3) == [1, 3]
+    paths.save()
+    assert cached_trees(small_graph(), cache_path) == 1
+    assert cached_trees(small_graph(weight=0.2), cache_path) == 0 # same topology, re-weighted
+    assert cached_trees(small_graph(length=0.3), cache_path) == 0 # same topology, other road lengths
+    assert RoadPaths(small_graph(weight=0.2), cache_path=cache_path).shortest_path(1, 3) == [1, 2, 3]
@@ -0,0 +1,44 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from utils import PipelineStats
+from road_graph import get_road_list, road_graph
+from graph_store import to_networkx
+from trajectory_store import read_trajectory_parts
+from trajectory import read_GPS_dataset, read_GPS_chunks, group_vehicle_readings, extract_vehicles, extract_chunks, order_trajectory_columns
+
+REPO_DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+
+
+@pytest.fixture
+def demo_dir(tmp_path, monkeypatch):
+    # demo day of the repository, in a scratch directory
+    os.makedirs(str(tmp_path / 'data'))
+    for name in ['ParsedTaxiData_20160314.csv', 'road_list.csv', 'road_graph.gml']:
+        shutil.copy(os.path.join(REPO_DATA, name), str(tmp_path / 'data'))
+    monkeypatch.chdir(tmp_path)
+
+
+def extract(max_memory=None, chunk_rows=100000):
+    # recovered trajectories of the demo day, as trajectory.py in a single pass or in chunks of max_memory MB (-M)
+    road_list = get_road_list(road_df=None, out_path='data/road_list.csv', update=False)
+    G = to_networkx(road_graph(road_df=None, out_path='data/road_graph.gml', update=False))
+    stats = PipelineStats()
+    if max_memory is None:
+        df = read_GPS_dataset(date_range=['20160314', '20160314'])
+        df = df[df['matched_road_id'].isin(road_list['road_id'])]
+        extract_vehicles(group_vehicle_readings(df, road_list), df['vehicle_id'].unique(), G, 'data/parts', stats=stats)
+        return read_trajectory_parts('data/parts'), stats.counters
+    chunks = read_GPS_chunks(date_range=['20160314', '20160314'], road_list=road_list, max_memory=max_memory, chunk_rows=chunk_rows)
+    vehicle_ids = extract_chunks(chunks, road_list, G, 'data/parts_chunked', stats=stats)
+    return order_trajectory_columns(read_trajectory_parts('data/parts_chunked'), vehicle_ids), stats.counters
+
+
+def test_chunked_extraction_equals_single_pass(demo_dir):
+    columns, counters = extract()
+    chunked_columns, chunked_counters = extract(max_memory=0.02, chunk_rows=100) # several chunks with carried readings
+    for column in columns:
+        np.testing.assert_array_equal(chunked_columns[column], columns[column])
+    assert chunked_counters == counters
+    assert counters['vehicles'] == 5
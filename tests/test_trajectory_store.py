@@ -0,0 +1,28 @@
+import numpy as np
+import pandas as pd
+from utils import date_timestamp
+from trajectory_store import write_trajectory_store, read_trajectory_store
+
+
+def test_read_time_range(tmp_path):
+    # points of two vehicles, not in time order, over two dates
+    start = date_timestamp('20160314')
+    timestamps = start + np.array([100, 5000, 90000, 50, 86399, 86400], dtype=np.int64)
+    road_list = pd.DataFrame({'road_id': [103000001, 103000002]})
+    store_path = str(tmp_path / 'recovered_trajectory_20160314_20160315')
+    write_trajectory_store({'vehicle_id': np.array(['A', 'A', 'A', 'B', 'B', 'B']),
+                            'trajectory_id': np.array([0, 0, 1, 0, 0, 1], dtype=np.int32),
+                            'timestamp': timestamps,
+                            'road_id': np.array([103000001, 103000002, 103000001, 103000002, 103000001, 103000002], dtype=np.int64),
+                            'scenario': np.full(6, 0.1, dtype=np.float32)}, store_path, road_list)
+
+    store = read_trajectory_store(store_path, columns=['vehicle_index', 'road_index'], start_time=start + 100, end_time=start + 86400)
+    np.testing.assert_array_equal(store['vehicle_index'], [0, 0, 1])
+    np.testing.assert_array_equal(store['road_index'], [0, 1, 0])
+    assert 'timestamp' not in store
+
+    store = read_trajectory_store(store_path, start_date='20160315', end_date='20160315')
+    np.testing.assert_array_equal(store['timestamp'], timestamps[[2, 5]])
+    store = read_trajectory_store(store_path, start_date='20160314', end_date='20160314', start_time=start + 60)
+    np.testing.assert_array_equal(store['timestamp'], timestamps[[0, 1, 4]])
+    assert len(read_trajectory_store(store_path)['timestamp']) == 6
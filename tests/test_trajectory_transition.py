@@ -0,0 +1,28 @@
+import os
+import pickle as pkl
+import numpy as np
+import pandas as pd
+from trajectory_transition import find_transition, extract_trajectory_transition
+
+
+def save_legacy(path, dense_transition):
+    with open(path, 'wb') as f:
+        pkl.dump(dense_transition, f)
+
+
+def test_legacy_range_total_is_rebuilt(tmp_path, monkeypatch):
+    # dense int8 .pkl files of former versions: two dates of 100 moves each, and their range total wrapped around in int8
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('data')
+    pd.DataFrame({'road_id': [103000001, 103000002]}).to_csv('data/road_list.csv', index=False)
+    day_transition = np.zeros((96, 2, 2), dtype=np.int8)
+    day_transition[10, 0, 1] = 100
+    for current_date in ['20160314', '20160315']:
+        save_legacy('data/trajectory_transition_%s_%s.pkl'%(current_date, current_date), day_transition)
+    save_legacy('data/trajectory_transition_20160314_20160315.pkl', (day_transition + day_transition).astype(np.int8))
+
+    assert find_transition('20160314', '20160314') == 'data/trajectory_transition_20160314_20160314.pkl'
+    assert find_transition('20160314', '20160315') is None
+    transition = extract_trajectory_transition('20160314', '20160315')
+    assert transition[10][0, 1] == 200
+    assert sum(matrix.sum() for matrix in transition) == 200
@@ -1,4 +1,5 @@
-# CUDA_VISIBLE_DEVICES=0 nohup python train_model.py -m TrGNN [-D sg_expressway_8weeks -p TrGNN_1581343606_100epoch.cpt -c 1] &
+# CUDA_VISIBLE_DEVICES=0 nohup python train_model.py -m TrGNN [-D sg_expressway_8weeks -p TrGNN_1581343606_100epoch.cpt -c 1 -f 1] &
+# one region of a partition (see train_regions.py): python train_model.py -m TrGNN -R data/regions_4_75hop.pkl -r 0 -P TrGNN_1581343606_region0
 import pandas as pd
 import time
 from datetime import date, timedelta
@@ -7,11 +8,15 @@ import os
 from utils import *
 import random
 import numpy as np
+import scipy.sparse as sp
 from math import radians, degrees, sin, cos, asin, acos, sqrt
 import pickle as pkl
 from metrics import *
 from trajectory_transition import extract_trajectory_transition
 from road_graph import extract_road_adj
+from flow_store import read_flows
+from postprocess import read_trajectory_metadata
+from feature_cache import cached_features, feature_window
 from model import *
 import torch
 import torch.nn as nn
@@ -27,16 +32,35 @@ parser.add_argument('-m', '--model_name', help='TrGNN', required=True)
 parser.add_argument('-D', '--dataset', help='sg_expressway_8weeks', default='sg_expressway_8weeks')
 parser.add_argument('-p', '--pre_trained', help='pre-trained model path. E.g. TrGNN_1581343606_100epoch.cpt', default='')
 parser.add_argument('-c', '--calibrate', help='flow calibration on a daily basis', default=1)
+parser.add_argument('-R', '--regions', help='regions file of train_regions.py. E.g. data/regions_4_75hop.pkl', default='')
+parser.add_argument('-r', '--region', help='index of the region to train, with -R', default=-1)
+parser.add_argument('-P', '--prefix', help='prefix of model, log and result files. E.g. TrGNN_1581343606_region0', default='')
+parser.add_argument('-e', '--num_epochs', default=100)
+parser.add_argument('-f', '--feature_cache', help='1: train on graph propagation features computed once (see feature_cache.py)', default=0)
 args = parser.parse_args()
 model_name, dataset, model_path, calibrate = args.model_name, args.dataset, args.pre_trained, bool(args.calibrate)
+regions_path, region, num_epochs, feature_cache = args.regions, int(args.region), int(args.num_epochs), bool(int(args.feature_cache))
 
 
 start_time = time.time()
 
 
+# Road segments: the whole graph, or a region. 
+# A region is made of core roads (predicted) and halo roads (within k hops of the core, for graph propagation only).
+# nodes: road index of the region in road_list, core roads first.
+road_adj = extract_road_adj() # directed adj. sparse
+if regions_path == '':
+    nodes, n_core = np.arange(road_adj.shape[0]), road_adj.shape[0]
+else:
+    with open(regions_path, 'rb') as f:
+        regions = pkl.load(f)['regions']
+    nodes, n_core = np.concatenate([regions[region]['core'], regions[region]['halo']]), len(regions[region]['core'])
+n_road = len(nodes)
+
+
 # Model and log
 models = {'TrGNN':Model_TrGNN, 'TrGNN-':Model_GNN}
-model = models[model_name]()
+model = models[model_name](n_road=n_road)
 if model_path == '': # if no pre-trained model path
     prefix = '%s_%s'%(model_name, int(start_time))
     checkpoint_epoch = -1
@@ -44,6 +68,8 @@ if os.path.isfile(model_path):
     model.load_state_dict(torch.load(model_path))
     prefix = '_'.join(model_path.split('_')[:2])
     checkpoint_epoch = int(model_path.split('_')[-1][:-9])
+if args.prefix != '':
+    prefix = args.prefix
 model_path = 'model/%s_%sepoch.cpt'%(prefix, '%d')
 log_path = 'log/%s.log'%prefix
 
@@ -52,11 +78,12 @@ log_path = 'log/%s.log'%prefix
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 model = model.to(device)
 print_log(device, log_path)
+if regions_path != '':
+    print_log('Region %d of %s: %d core roads, %d halo roads'%(region, regions_path, n_core, n_road - n_core), log_path)
 
 
 # Dataset
 # 'sg_expressway_4weeks', 'sg_expressway_8weeks'
-road_adj = extract_road_adj() # directed adj
 
 if dataset == 'demo':
     start_date, end_date = '20160314', '20160314'
@@ -67,9 +94,9 @@ else:
     start_date, end_date = '20160401', '20160421' # train period + validation period
 trajectory_transition = extract_trajectory_transition(start_date, end_date)
 # smoothing with binary road_adj, in case no historical flow is recorded.
-road_adj_mask = np.zeros(road_adj.shape)
-road_adj_mask[road_adj > 0] = 1
-np.fill_diagonal(road_adj_mask, 0)
+road_adj_mask = (road_adj > 0).astype(np.float64) # sparse, as trajectory_transition is a list of sparse matrices
+road_adj_mask.setdiag(0)
+road_adj_mask.eliminate_zeros()
 for i in range(len(trajectory_transition)):
     trajectory_transition[i] = trajectory_transition[i] + road_adj_mask
 
@@ -80,16 +107,16 @@ elif dataset == 'sg_expressway_8weeks':
     start_date, end_date = '20160314', '20160508' # train (5 weeks) + validation (1 week) + test (2 weeks)
 else:
     start_date, end_date = '20160401', '20160428' # train + validation + test
-dates = date_range(start_date, end_date)
-flow_df = pd.concat([pd.read_csv('data/flow_%s_%s.csv'%(date, date), index_col=0) for date in dates])
-flow_df.columns = pd.Index(int(road_id) for road_id in flow_df.columns)
+flow_df = read_flows(start_date, end_date, interval=15) # from the flow store
 # flow calibration on a daily basis
 if calibrate:
     print_log('Calibrating flow...', log_path)
-    trajectory_metadata = pd.read_csv('data/trajectory_metadata.csv') # read trajectory metadata
+    trajectory_metadata = read_trajectory_metadata(start_date, end_date) # read trajectory metadata of the dates of flow_df
     multipliers = np.repeat(np.array(trajectory_metadata['vehicles'][0] / trajectory_metadata['vehicles']), 96)
     multipliers[multipliers==np.inf]=0
     flow_df = flow_df.mul(multipliers, axis=0)
+if regions_path != '':
+    flow_df = flow_df.iloc[:, nodes] # roads of the region
 print_log(flow_df.shape, log_path)
 print_log('Total flow: %d'%(flow_df.sum().sum()), log_path)
 
@@ -124,7 +151,7 @@ scaler = StandardScaler().fit(flow_df.iloc[indices['train'] + indices['val']].va
 # Train model
 loss_fn = nn.MSELoss()
 learning_rate = 0.004
-num_epochs = 100
+num_epochs = num_epochs # 100 by default
 min_mae = 10 # initialize
 early_stop_threshold = 3.0 # for val_mae
 # result_function = result_analysis2 if dataset == 'sg_expressway_8weeks' else result_analysis
@@ -136,11 +163,11 @@ def validate(mode='val'):
     running_loss = 0
     n_samples = 0
     
-    h_init = torch.zeros(5, 2404, 1) # (gru_num_layers, n_road, hidden_size)
+    h_init = torch.zeros(5, n_road, 1) # (gru_num_layers, n_road, hidden_size)
     h_init = h_init.to(device)
     
-    Y_true = np.zeros((len(indices[mode]), 2404)) # (n_sample, n_road)
-    Y_pred = np.zeros((len(indices[mode]), 2404))
+    Y_true = np.zeros((len(indices[mode]), n_core)) # (n_sample, n_core). core roads only
+    Y_pred = np.zeros((len(indices[mode]), n_core))
     for i in indices[mode]:
 
         d = i // 92
@@ -151,14 +178,17 @@ def validate(mode='val'):
         # W passed to device already
         y_true = normalized_flows[d*96+t+4]
         
-        ToD = torch.from_numpy(np.eye(24)[np.full((2404), ((t+4) * 15 // 60) % 24)]).float().to(device) # one-hot encoding: hour of day. (n_road, 24)
-        DoW = torch.from_numpy(np.full((2404, 1), int(d in weekdays))).float().to(device) # indicator: 1 for weekdays, 0 for weekends/PHs. (n_road, 1)
-        y_pred = model(X, T, W, h_init, W_norm, ToD, DoW)
+        ToD = torch.from_numpy(np.eye(24)[np.full((n_road), ((t+4) * 15 // 60) % 24)]).float().to(device) # one-hot encoding: hour of day. (n_road, 24)
+        DoW = torch.from_numpy(np.full((n_road, 1), int(d in weekdays))).float().to(device) # indicator: 1 for weekdays, 0 for weekends/PHs. (n_road, 1)
+        if feature_cache:
+            y_pred = model.predict(feature_window(H_features, d, t).to(device), feature_window(S_features, d, t).to(device), ToD, DoW)
+        else:
+            y_pred = model(X, T, W, h_init, W_norm, ToD, DoW)
         
-        Y_true[n_samples] = flow_df.iloc[d*96+t+4].values
-        Y_pred[n_samples] = scaler.inverse_transform(y_pred.detach().cpu().numpy())
+        Y_true[n_samples] = flow_df.iloc[d*96+t+4].values[:n_core]
+        Y_pred[n_samples] = scaler.inverse_transform(y_pred.detach().cpu().numpy())[:n_core]
         
-        loss = loss_fn(y_pred, y_true)
+        loss = loss_fn(y_pred[:n_core], y_true[:n_core])
         loss.detach_()
 
         running_loss += loss.item()
@@ -176,9 +206,13 @@ def validate(mode='val'):
 # preprocessing
 print_log('Preprocessing...', log_path)
 normalized_flows = torch.from_numpy(scaler.transform(flow_df.values)).float().to(device) # for X. normalized
-transitions_ToD = [to_sparse_tensor(normalize_adj(trajectory_transition[i])).to(device) for i in range(len(trajectory_transition))] # for T. time of day
-W = torch.from_numpy(road_adj).to(device) # for W
-W_norm = torch.from_numpy(normalize_adj(road_adj, mode='aggregation')).to(device) # for normalized W
+# normalized on the whole graph, then restricted to the roads of the region
+transitions_ToD = [to_sparse_tensor(normalize_adj(trajectory_transition[i])[nodes][:, nodes]).to(device) for i in range(len(trajectory_transition))] # for T. time of day
+W = to_sparse_tensor(road_adj[nodes][:, nodes]).to(device) # for W
+W_norm = to_sparse_tensor(normalize_adj(road_adj, mode='aggregation')[nodes][:, nodes]).to(device) # for normalized W
+if feature_cache:
+    H_features, S_features = cached_features(model, normalized_flows, transitions_ToD, W_norm) # memory-mapped. (n_day, 96, n_road, n_feature)
+    print_log('Feature cache: H %s, S %s'%(H_features.shape, S_features.shape), log_path)
 print_log('Preprocessing completed. Clock: %.0f seconds'%(time.time() - start_time), log_path)
 
 print_log('Training model...', log_path)
@@ -190,7 +224,7 @@ for epoch in range(checkpoint_epoch+1, num_epochs):
         learning_rate /= 2
     
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
-    h_init = torch.zeros(5, 2404, 1) # (gru_num_layers, n_road, hidden_size)
+    h_init = torch.zeros(5, n_road, 1) # (gru_num_layers, n_road, hidden_size)
     h_init = h_init.to(device)
     
     running_loss = 0
@@ -209,10 +243,13 @@ for epoch in range(checkpoint_epoch+1, num_epochs):
         y_true = normalized_flows[d*96+t+4] # (n_road)
         
         optimizer.zero_grad()
-        ToD = torch.from_numpy(np.eye(24)[np.full((2404), ((t+4) * 15 // 60) % 24)]).float().to(device) # one-hot encoding: hour of day. (n_road, 24)
-        DoW = torch.from_numpy(np.full((2404, 1), int(d in weekdays))).float().to(device) # indicator: 1 for weekdays, 0 for weekends/PHs. (n_road, 1)
-        y_pred = model(X, T, W, h_init, W_norm, ToD, DoW)
-        loss = loss_fn(y_pred, y_true)
+        ToD = torch.from_numpy(np.eye(24)[np.full((n_road), ((t+4) * 15 // 60) % 24)]).float().to(device) # one-hot encoding: hour of day. (n_road, 24)
+        DoW = torch.from_numpy(np.full((n_road, 1), int(d in weekdays))).float().to(device) # indicator: 1 for weekdays, 0 for weekends/PHs. (n_road, 1)
+        if feature_cache: # graph propagation of slots t to t+3 of day d, computed once
+            y_pred = model.predict(feature_window(H_features, d, t).to(device), feature_window(S_features, d, t).to(device), ToD, DoW)
+        else:
+            y_pred = model(X, T, W, h_init, W_norm, ToD, DoW)
+        loss = loss_fn(y_pred[:n_core], y_true[:n_core]) # halo roads are not predicted
         loss.backward()
         
         optimizer.step()
@@ -0,0 +1,131 @@
+# nohup python train_regions.py -m TrGNN -n 4 -k 75 -j 4 [-D sg_expressway_8weeks -c 1] &
+import os
+import sys
+import time
+import glob
+import subprocess
+import pickle as pkl
+import argparse
+import numpy as np
+from scipy.sparse.csgraph import reverse_cuthill_mckee
+from multiprocessing import Pool, cpu_count
+from utils import print_log
+from metrics import MAE, MAPE, RMSE
+from road_graph import extract_road_adj
+
+
+# Regional training: the road graph is split into balanced regions, one TrGNN model is trained per region
+# (train_model.py -R -r, in separate processes), and the predictions of the core roads of each region are stitched back by road index.
+# Each region is extended by a halo: the roads within k hops of its core (in either direction).
+# Graph propagation of h hops is exact for core roads if k >= h. Halo roads are propagated through, but not predicted.
+
+def partition_roads(road_adj, n_regions):
+    # Balanced regions of road index: equal chunks of the reverse Cuthill-McKee order of the undirected graph,
+    # which keeps adjacent roads close in the order.
+    # output: list of n_regions sorted arrays of road index
+    symm_adj = (road_adj + road_adj.transpose()).tocsr()
+    order = reverse_cuthill_mckee(symm_adj, symmetric_mode=True)
+    return [np.sort(chunk) for chunk in np.array_split(order, n_regions)]
+
+
+def halo_roads(road_adj, core, hops):
+    # road index within hops of core, in either direction, excluding core. road_adj: sparse (n_road, n_road)
+    symm_adj = ((road_adj + road_adj.transpose()) != 0).astype(np.int32).tocsr()
+    reached = np.zeros(road_adj.shape[0], dtype=bool)
+    reached[core] = True
+    frontier = reached.copy()
+    for hop in range(hops):
+        frontier = (symm_adj.dot(frontier.astype(np.int32)) > 0) & ~reached
+        if not frontier.any():
+            break
+        reached |= frontier
+    reached[core] = False
+    return np.flatnonzero(reached)
+
+
+def build_regions(road_adj, n_regions, halo_hops, out_path):
+    # Save the regions as a pickled dict: {'halo_hops': k, 'regions': list of {'core': road index, 'halo': road index}}
+    regions = [{'core': core, 'halo': halo_roads(road_adj, core, halo_hops)} for core in partition_roads(road_adj, n_regions)]
+    with open(out_path, 'wb') as f:
+        pkl.dump({'halo_hops': halo_hops, 'regions': regions}, f)
+    return regions
+
+
+def train_region(region_args):
+    # Worker: train the model of one region in a separate process, with threads torch threads. output: exit code
+    command, threads = region_args
+    return subprocess.call(command, env=dict(os.environ, OMP_NUM_THREADS=str(threads)))
+
+
+def latest_results(prefix):
+    # (Y_true, Y_pred) of the last saved epoch, i.e. the best validation MAE, of a region
+    pred_paths = glob.glob('result/%s_*epoch_Y_pred.pkl'%(prefix))
+    if len(pred_paths) == 0:
+        return None, None
+    pred_path = max(pred_paths, key=lambda path: int(path.split('_')[-3][:-5]))
+    with open('result/%s_Y_true.pkl'%(prefix), 'rb') as f:
+        Y_true = pkl.load(f)
+    with open(pred_path, 'rb') as f:
+        Y_pred = pkl.load(f)
+    return Y_true, Y_pred
+
+
+if __name__ == '__main__':
+
+    # Arguments
+    parser = argparse.ArgumentParser(description='train_regions')
+    parser.add_argument('-m', '--model_name', help='TrGNN', required=True)
+    parser.add_argument('-D', '--dataset', help='sg_expressway_8weeks', default='sg_expressway_8weeks')
+    parser.add_argument('-c', '--calibrate', help='flow calibration on a daily basis', default=1)
+    parser.add_argument('-n', '--n_regions', help='number of regions', default=4)
+    parser.add_argument('-k', '--halo_hops', help='hops of the halo around each region. demand_hop (75) for exact propagation', default=75)
+    parser.add_argument('-j', '--num_workers', help='number of regions trained at the same time', default=1)
+    parser.add_argument('-e', '--num_epochs', default=100)
+    args = parser.parse_args()
+    model_name, dataset, calibrate = args.model_name, args.dataset, int(args.calibrate)
+    n_regions, halo_hops, num_workers, num_epochs = int(args.n_regions), int(args.halo_hops), int(args.num_workers), int(args.num_epochs)
+    threads = max(1, cpu_count() // num_workers) # torch threads per process
+
+    start_time = time.time()
+    prefix = '%s_%s'%(model_name, int(start_time))
+    log_path = 'log/%s.log'%prefix
+
+    # partition
+    road_adj = extract_road_adj()
+    regions_path = 'data/regions_%d_%dhop.pkl'%(n_regions, halo_hops)
+    if os.path.exists(regions_path):
+        print_log('Regions exist', log_path)
+        with open(regions_path, 'rb') as f:
+            regions = pkl.load(f)['regions']
+    else:
+        print_log('Partitioning %d roads into %d regions with %d-hop halo'%(road_adj.shape[0], n_regions, halo_hops), log_path)
+        regions = build_regions(road_adj, n_regions, halo_hops, regions_path)
+    for k, region in enumerate(regions):
+        print_log('Region %d: %d core roads, %d halo roads'%(k, len(region['core']), len(region['halo'])), log_path)
+
+    # train each region in a separate process
+    region_args = [([sys.executable, 'train_model.py', '-m', model_name, '-D', dataset, '-c', str(calibrate), '-e', str(num_epochs),
+                 '-R', regions_path, '-r', str(k), '-P', '%s_region%d'%(prefix, k)], threads) for k in range(len(regions))]
+    pool = Pool(num_workers) if num_workers > 1 else None
+    exit_codes = pool.map(train_region, region_args) if pool is not None else [train_region(args) for args in region_args]
+    if pool is not None:
+        pool.close()
+        pool.join()
+    print_log('Regions trained with exit codes %s. Clock: %.0f seconds'%(exit_codes, time.time() - start_time), log_path)
+
+    # stitch the test predictions of core roads by road index
+    Y_true, Y_pred = None, None
+    for k, region in enumerate(regions):
+        region_Y_true, region_Y_pred = latest_results('%s_region%d'%(prefix, k))
+        if region_Y_pred is None:
+            print_log('No result for region %d'%(k), log_path)
+            continue
+        if Y_pred is None:
+            Y_true, Y_pred = np.zeros((region_Y_true.shape[0], road_adj.shape[0])), np.zeros((region_Y_pred.shape[0], road_adj.shape[0]))
+        Y_true[:, region['core']], Y_pred[:, region['core']] = region_Y_true, region_Y_pred
+    if Y_pred is not None:
+        print_log('>> stitched test MAE: %.3f, MAPE: %.3f, RMSE: %.3f'%(MAE(Y_pred, Y_true), MAPE(Y_pred, Y_true), RMSE(Y_pred, Y_true)), log_path)
+        with open('result/%s_Y_true.pkl'%(prefix), 'wb') as f:
+            pkl.dump(Y_true, f)
+        with open('result/%s_Y_pred.pkl'%(prefix), 'wb') as f:
+            pkl.dump(Y_pred, f)
@@ -4,11 +4,15 @@ import time
 import pandas as pd
 import numpy as np
 import argparse
+from multiprocessing import Pool
 from datetime import datetime as dt
 from datetime import date, timedelta
 import networkx as nx
-from utils import time_difference
+from utils import to_timestamp, PipelineStats
 from road_graph import get_road_list, road_graph
+from graph_store import to_networkx
+from road_path import road_paths
+from trajectory_store import trajectory_store_path, write_trajectory_store, export_trajectory_csv, append_trajectory_part, read_trajectory_parts
 
 
 def read_GPS_dataset(date_range=['20160325', '20160325'], in_path='data/ParsedTaxiData_%s.csv', test_mode=False):
@@ -23,68 +27,222 @@ def read_GPS_dataset(date_range=['20160325', '20160325'], in_path='data/ParsedTa
         df_list = [pd.read_csv(in_path%(date), nrows=100000).drop_duplicates() for date in date_list]
     else:
         df_list = [pd.read_csv(in_path%(date)).drop_duplicates() for date in date_list]
+    for df in df_list:
+        df['timestamp'] = to_timestamp(df['time']) # parse time strings once per file
     df = pd.concat(df_list)
     return df
 
 
+def read_GPS_chunks(date_range=['20160325', '20160325'], in_path='data/ParsedTaxiData_%s.csv', road_list=None, max_memory=None, time_gap=10, chunk_rows=100000, test_mode=False):
+    # Streaming version of read_GPS_dataset for long date ranges. GPS files are expected in time order.
+    # Yields chunks of readings (vehicle_id, time, matched_road_id, timestamp, row) with fixed dtypes. row: position in the GPS files.
+    # one chunk per day, or per time window of about max_memory MB if max_memory is set.
+    # road_list: if not None, readings on other road segments are dropped while reading.
+    # Duplicates are dropped within each chunk.
+    # Vehicles that may continue across a chunk boundary (last reading within time_gap minutes of the end of the chunk)
+    # carry their readings since their last gap of more than time_gap minutes over to the next chunk.
+    # Such a gap starts a new trajectory (Scenario 1.1), so no trajectory is cut by a chunk boundary.
+    print('Reading GPS dataset in chunks')
+    start_date, end_date = date_range
+    start_date, end_date = dt.strptime(start_date, '%Y%m%d'), dt.strptime(end_date, '%Y%m%d')
+    date_list = [(start_date + timedelta(i)).strftime('%Y%m%d') for i in range((end_date - start_date).days+1)]
+    dtype = {'vehicle_id': str, 'time': str, 'matched_road_id': np.int64}
+    max_bytes = None if max_memory is None else max_memory * 2**20
+    carry = None
+    n_rows = 0
+    for date in date_list:
+        pieces, size = [], 0
+        reader = pd.read_csv(in_path%(date), usecols=list(dtype), dtype=dtype, chunksize=chunk_rows, nrows=100000 if test_mode else None)
+        for piece in reader:
+            piece = piece.assign(row=np.arange(n_rows, n_rows + len(piece)))
+            n_rows += len(piece)
+            if road_list is not None:
+                piece = piece[piece['matched_road_id'].isin(road_list['road_id'])]
+            piece = piece.assign(timestamp=to_timestamp(piece['time'])) # parse time strings once
+            pieces.append(piece)
+            size += piece.memory_usage(deep=True).sum()
+            if max_bytes is not None and size >= max_bytes:
+                chunk, carry = split_GPS_chunk(carry, pieces, time_gap=time_gap)
+                print('Chunk of %s readings till %s'%(len(chunk), date))
+                yield chunk
+                pieces, size = [], carry.memory_usage(deep=True).sum()
+        chunk, carry = split_GPS_chunk(carry, pieces, time_gap=time_gap)
+        print('Chunk of %s readings till %s'%(len(chunk), date))
+        yield chunk
+    if carry is not None and len(carry) > 0:
+        print('Chunk of %s carried readings'%(len(carry)))
+        yield carry
+
+
+def split_GPS_chunk(carry, pieces, time_gap=10):
+    # Concatenate readings carried over from the previous chunk and new pieces, drop duplicates,
+    # and split off the readings to carry over to the next chunk (see read_GPS_chunks).
+    # output: (chunk, carry)
+    chunk = pd.concat(([carry] if carry is not None else []) + pieces, ignore_index=True)
+    chunk = chunk.drop_duplicates(subset=['vehicle_id', 'time', 'matched_road_id']).reset_index(drop=True)
+    if len(chunk) == 0:
+        return chunk, chunk
+    order = np.lexsort((chunk['timestamp'].values, chunk['vehicle_id'].values))
+    vehicle_ids, times = chunk['vehicle_id'].values[order], chunk['timestamp'].values[order]
+    n = len(chunk)
+    new_vehicle = np.r_[True, vehicle_ids[1:] != vehicle_ids[:-1]]
+    segment_start = new_vehicle.copy()
+    segment_start[1:] |= times[1:] - times[:-1] > 60 * time_gap
+    segment_id = np.cumsum(segment_start)
+    vehicle_index = np.cumsum(new_vehicle) - 1
+    last_row = np.r_[np.flatnonzero(new_vehicle)[1:], n] - 1
+    open_vehicle = times[last_row] >= times.max() - 60 * time_gap
+    carried = np.zeros(n, dtype=bool)
+    carried[order] = open_vehicle[vehicle_index] & (segment_id == segment_id[last_row][vehicle_index])
+    return chunk[~carried], chunk[carried]
+
+
 def shortest_distance(G, road_id1, road_id2):
-    if road_id1 == road_id2:
-        return 0
-    shortest_path_length = nx.dijkstra_path_length(G, road_id1, road_id2)
-    shortest_distance = shortest_path_length - G.node[road_id1]['length']/2 - G.node[road_id2]['length']/2
-    return shortest_distance
+    return road_paths(G).shortest_distance(road_id1, road_id2)
+
+
+def group_vehicle_readings(df, road_list):
+    # Filter GPS readings to road_list and sort by (vehicle_id, time), once for all vehicles.
+    # Time strings are parsed once into the int64 column 'timestamp'.
+    # output: (readings, offsets). readings of each vehicle are rows offsets[vehicle_id] = (start, end) of readings.
+    columns = ['vehicle_id', 'time', 'timestamp', 'matched_road_id'] if 'timestamp' in df.columns else ['vehicle_id', 'time', 'matched_road_id']
+    readings = df[columns].rename(columns={'matched_road_id':'road_id'})
+    readings = readings[readings['road_id'].isin(road_list['road_id'])]
+    if 'timestamp' not in readings.columns:
+        readings = readings.assign(timestamp=to_timestamp(readings['time']))
+    # compulsory step: sort by time. stable sort, so readings at the same time stay in file order
+    readings = readings.sort_values(by=['vehicle_id', 'timestamp'], kind='mergesort')
+    readings = readings.reset_index().drop('index', axis=1)
+    vehicle_ids = readings['vehicle_id'].values
+    starts = np.flatnonzero(np.r_[True, vehicle_ids[1:] != vehicle_ids[:-1]]) if len(readings) > 0 else np.array([], dtype=np.int64)
+    ends = np.r_[starts[1:], len(readings)].astype(np.int64)
+    offsets = dict(zip(vehicle_ids[starts], zip(starts, ends)))
+    return readings, offsets
 
 
-def extract_vehicle_readings(df, vehicle_id):
-    # Extract GPS readings for this vehicle
-    vehicle_df = df[df['vehicle_id']==vehicle_id][['vehicle_id', 'time', 'matched_road_id']].rename(columns={'matched_road_id':'road_id'})
-    vehicle_df = vehicle_df.merge(road_list, on='road_id', how='inner')
-    vehicle_df = vehicle_df.sort_values(by='time') # compulsory step: sort by time
-    vehicle_df = vehicle_df.reset_index().drop('index', axis=1)
-    return vehicle_df
+def extract_vehicle_readings(grouped_readings, vehicle_id):
+    # Extract GPS readings for this vehicle: a slice of the grouped readings, without copy
+    readings, offsets = grouped_readings
+    start, end = offsets.get(vehicle_id, (0, 0))
+    return readings.iloc[start:end]
 
 
-def extract_trajectory(vehicle_df, G, time_gap=10, stay_duration=10, speed_limit=120, verb=True):
+def segment_readings(vehicle_ids, times, road_ids, time_gap=10, stay_duration=10, continuing=None):
+    # Vectorized trajectory segmentation for readings sorted by (vehicle, time).
+    # vehicle_ids, road_ids: arrays. times: int64 timestamps in seconds.
+    # continuing: None, or bool array. True for readings of vehicles continuing readings segmented before (e.g. in a previous chunk),
+    #             whose first reading starts a new trajectory (Scenario 1.1) instead of Scenario 0.1.
+    # Evaluates Scenarios 0.2, 1.1 and 1.2 for all readings (of one or many vehicles) at once.
+    # The graph-dependent Scenarios 1.3 and 1.4 are left to the caller, for candidate readings only.
+    # output:
+    #   keep: readings kept after Scenario 0.2 and the drops of Scenario 1.2. bool array
+    #   scenario: 0.1, 0.2, 1.1, 1.2, or nan. float array
+    #   candidate: readings to check for Scenarios 1.3 and 1.4 against the previous kept reading. bool array
+    #   previous: position of the previous kept reading (-1 for the first reading of a vehicle). int array
+    n = len(times)
+    vehicle_ids, times, road_ids = np.asarray(vehicle_ids), np.asarray(times, dtype=np.int64), np.asarray(road_ids)
+    scenario = np.full(n, np.nan)
+    keep = np.zeros(n, dtype=bool)
+    candidate = np.zeros(n, dtype=bool)
+    previous = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return keep, scenario, candidate, previous
+    
+    new_vehicle = np.ones(n, dtype=bool)
+    new_vehicle[1:] = vehicle_ids[1:] != vehicle_ids[:-1]
+    # Scenario 0.2: same timing for multiple records, skip the following records
+    same_time = np.zeros(n, dtype=bool)
+    same_time[1:] = (times[1:] == times[:-1]) & ~new_vehicle[1:]
+    scenario[same_time] = 0.2
+    
+    # Work on the readings that survive Scenario 0.2. Consecutive kept readings are (previous_row, row).
+    kept = np.flatnonzero(~same_time)
+    k_new_vehicle = new_vehicle[kept]
+    k_times = times[kept]
+    k_roads = road_ids[kept]
+    m = len(kept)
+    positions = np.arange(m)
+    previous[kept[~k_new_vehicle]] = kept[np.flatnonzero(~k_new_vehicle) - 1]
+    
+    # stay start time: time of the first reading of the current run on the same road segment
+    run_start = k_new_vehicle.copy()
+    run_start[1:] |= k_roads[1:] != k_roads[:-1]
+    run_start_position = np.maximum.accumulate(np.where(run_start, positions, 0))
+    stay_start_time = k_times[run_start_position]
+    
+    elapsed = np.zeros(m, dtype=np.int64)
+    elapsed[1:] = k_times[1:] - k_times[:-1]
+    # Scenario 0.1: for the first reading, just record
+    k_scenario = np.where(k_new_vehicle, 0.1, np.nan)
+    if continuing is not None:
+        k_scenario[k_new_vehicle & np.asarray(continuing)[kept]] = 1.1
+    # Scenario 1.1. time gap is too long
+    gap = ~k_new_vehicle & (elapsed > 60 * time_gap)
+    # Scenario 1.2. stay at the same road segment for too long
+    stay = ~k_new_vehicle & ~gap & (k_times - stay_start_time > 60 * stay_duration)
+    k_scenario[gap] = 1.1
+    k_scenario[stay] = 1.2
+    scenario[kept] = k_scenario
+    # Scenario 1.2 drops the intermediate points of the stay, keeping the two end points.
+    # A later 1.2 reading of the same run drops everything an earlier one dropped, plus the earlier one itself.
+    run_id = np.cumsum(run_start) - 1
+    last_stay = np.full(run_id[-1] + 1, -1, dtype=np.int64)
+    np.maximum.at(last_stay, run_id[stay], positions[stay])
+    dropped = (positions > run_start_position) & (positions < last_stay[run_id])
+    keep[kept[~dropped]] = True
+    
+    # Scenarios 1.3 and 1.4 only apply when the road segment changes and 1.1 does not hold
+    candidate[kept] = run_start & ~k_new_vehicle & ~gap
+    return keep, scenario, candidate, previous
+
+
+def extract_trajectory(vehicle_df, G, time_gap=10, stay_duration=10, speed_limit=120, verb=True, stats=None, continuing=False):
     
     # Trajectory extraction
-    trajectory_df = pd.DataFrame(columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
-    for i, row in vehicle_df.iterrows():
-        if i == 0: # Scenario 0.1: for the first reading, just record
-            row['scenario'] = 0.1
-            stay_start_time = row['time'] # to record the start of stay at the same road segment
-            trajectory_id = 0
-        else: 
-            if row['time'] == previous_row['time']: # Scenario 0.2: same timing for multiple records, skip the following records
-                if verb: print('Point %s S0.2. same timing for multiple records, skip the following records'%(i))
-                row['scenario'] = 0.2
-                continue
-            if previous_row['road_id'] != row['road_id']:
-                stay_start_time = row['time'] # update stay start time
-            # Scenarios to start a new trajectory
-            if time_difference(row['time'], previous_row['time']) > 60 * time_gap: # Scenario 1.1. time gap is too long
-                if verb: print('Point %s S1.1. time gap is too long'%(i))
-                row['scenario'] = 1.1
-                trajectory_id += 1
-            elif time_difference(row['time'], stay_start_time) > 60 * stay_duration: # Scenario 1.2. stay at the same road segment for too long
-                if verb: print('Point %s S1.2. stay at the same road segment for too long'%(i))
-                row['scenario'] = 1.2
-                drop_indices = trajectory_df[trajectory_df['time'].apply(
-                    lambda t: (time_difference(t, stay_start_time) > 0) & (time_difference(row['time'], t) > 0))].index
-                trajectory_df = trajectory_df.drop(drop_indices) # drop intermediate points
-                trajectory_id += 1 # keep the two end points, but in different trajectories
-            elif not nx.has_path(G, previous_row['road_id'], row['road_id']): # Scenario 1.3. cannot find path between two points
-                if verb: print('Point %s S1.3. cannot find path between two points'%(i))
-                row['scenario'] = 1.3
-                trajectory_id += 1
-            elif shortest_distance(G, previous_row['road_id'], row['road_id']) / time_difference(row['time'], previous_row['time']) * 3600 > 120:  # Scenario 1.4. driver drives exceptionally fast
-                if verb: print('Point %s S1.4. driver drives exceptionally fast'%(i))
-                row['scenario'] = 1.4
-                if verb: print(shortest_distance(G, previous_row['road_id'], row['road_id']))
-                if verb: print(time_difference(row['time'], previous_row['time']))
-                trajectory_id += 1
-        row['trajectory_id'] = trajectory_id
-        trajectory_df = trajectory_df.append(row, ignore_index=True)
-        previous_row = row
+    # vehicle_df: readings sorted by time (and by vehicle if there are several vehicles)
+    # stats: None, or PipelineStats to count readings per scenario
+    # continuing: True if the vehicles of vehicle_df continue readings extracted before (see segment_readings)
+    vehicle_ids = vehicle_df['vehicle_id'].values
+    times = vehicle_df['timestamp'].values if 'timestamp' in vehicle_df.columns else to_timestamp(vehicle_df['time'])
+    road_ids = vehicle_df['road_id'].values
+    keep, scenario, candidate, previous = segment_readings(vehicle_ids, times, road_ids, time_gap=time_gap, stay_duration=stay_duration, 
+                                                           continuing=np.full(len(times), continuing, dtype=bool))
+    
+    # Graph-dependent scenarios, evaluated per candidate pair only
+    paths = road_paths(G)
+    for i in np.flatnonzero(candidate):
+        O, D = road_ids[previous[i]], road_ids[i]
+        if not paths.has_path(O, D): # Scenario 1.3. cannot find path between two points
+            scenario[i] = 1.3
+        elif paths.shortest_distance(O, D) / (times[i] - times[previous[i]]) * 3600 > speed_limit: # Scenario 1.4. driver drives exceptionally fast
+            scenario[i] = 1.4
+    if verb:
+        messages = {0.2: 'S0.2. same timing for multiple records, skip the following records',
+                    1.1: 'S1.1. time gap is too long',
+                    1.2: 'S1.2. stay at the same road segment for too long',
+                    1.3: 'S1.3. cannot find path between two points',
+                    1.4: 'S1.4. driver drives exceptionally fast'}
+        for i in np.flatnonzero(~np.isnan(scenario) & (scenario != 0.1)):
+            print('Point %s %s'%(i, messages[scenario[i]]))
+    if stats is not None:
+        stats.count('readings', len(scenario))
+        for value in [0.1, 0.2, 1.1, 1.2, 1.3, 1.4]:
+            stats.count('scenario_%s'%(value), np.sum(scenario == value))
+        stats.count('dropped_1.2', np.sum(~keep & (scenario != 0.2))) # intermediate points of long stays
+    
+    # A new trajectory starts at each of Scenarios 1.1-1.4. trajectory_id restarts from 0 for each vehicle.
+    split = np.isin(scenario, [1.1, 1.2, 1.3, 1.4]).astype(np.int64)
+    trajectory_ids = np.cumsum(split)
+    positions = np.arange(len(vehicle_ids))
+    new_vehicle = np.r_[True, vehicle_ids[1:] != vehicle_ids[:-1]][:len(vehicle_ids)]
+    trajectory_ids = trajectory_ids - trajectory_ids[np.maximum.accumulate(np.where(new_vehicle, positions, 0))]
+    
+    trajectory_df = pd.DataFrame({'vehicle_id': vehicle_ids[keep],
+                                  'trajectory_id': trajectory_ids[keep],
+                                  'time': vehicle_df['time'].values[keep],
+                                  'road_id': road_ids[keep],
+                                  'scenario': scenario[keep]},
+                                 columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
     
     return trajectory_df
 
@@ -114,57 +272,197 @@ def recover_trajectory(cleaned_trajectory_df, G):
     # Scenario 3.1. For points that are not adjacent,
     # apply Dijkstra's shortest path algorithm to recover intermediate points.
     # Timing follows D time in O-D.
-    recovered_trajectory_df = pd.DataFrame(columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
-    for i, row in cleaned_trajectory_df.iterrows():
-        if i == 0:
-            point_index = 0 # index of a point in a trajectory
-        else:
-            point_index = point_index + 1 if previous_row['trajectory_id'] == row['trajectory_id'] else 0
-        if point_index ==0:
-            recovered_trajectory_df = recovered_trajectory_df.append(row, ignore_index=True)
-        if point_index > 0:
-            O = previous_row['road_id']
-            D = row['road_id']
-            if O == D:
-                recovered_trajectory_df = recovered_trajectory_df.append(row, ignore_index=True)
-            else: # O != D
-                road_ids = nx.dijkstra_path(G, O, D)
-                for road_id in road_ids[1:]: # add intermediate points and end points
-                    row['road_id'] = road_id
-                    row['scenario'] = 3.1
-                    recovered_trajectory_df = recovered_trajectory_df.append(row, ignore_index=True)
-        previous_row = row
+    # Rows are collected in a list, and the data frame is built once.
+    paths = road_paths(G)
+    columns = ['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario']
+    vehicle_ids, trajectory_ids, times, road_ids, scenarios = [cleaned_trajectory_df[column].values for column in columns]
+    rows = []
+    for i in range(len(cleaned_trajectory_df)):
+        if i == 0 or trajectory_ids[i] != trajectory_ids[i - 1] or road_ids[i] == road_ids[i - 1]:
+            # first point of a trajectory, or O == D
+            rows.append((vehicle_ids[i], trajectory_ids[i], times[i], road_ids[i], scenarios[i]))
+        else: # O != D
+            for road_id in paths.shortest_path(road_ids[i - 1], road_ids[i])[1:]: # add intermediate points and end points
+                rows.append((vehicle_ids[i], trajectory_ids[i], times[i], road_id, 3.1))
     
-    return recovered_trajectory_df
+    return pd.DataFrame(rows, columns=columns)
 
 
-def get_trajectory(df, vehicle_id, G, time_gap=10, stay_duration=2, speed_limit=120, verb=False):
-    vehicle_df = extract_vehicle_readings(df, vehicle_id)
-    trajectory_df = extract_trajectory(vehicle_df, G, verb=False, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit)
+def get_trajectory(grouped_readings, vehicle_id, G, time_gap=10, stay_duration=2, speed_limit=120, verb=False, next_trajectory_id=None, stats=None):
+    # grouped_readings: output of group_vehicle_readings
+    # next_trajectory_id: None, or dict of vehicle_id -> first trajectory_id to use, updated after extraction.
+    #                     For trajectory_id to continue across chunks of readings. A vehicle in it continues its readings:
+    #                     its first reading starts a new trajectory (Scenario 1.1), as its time gap exceeds time_gap.
+    # stats: None, or PipelineStats updated with stage times, scenario counts and a record for this vehicle
+    paths = road_paths(G)
+    search_time, dijkstra_calls = paths.search_time, paths.dijkstra_calls()
+    start_time = time.time()
+    vehicle_df = extract_vehicle_readings(grouped_readings, vehicle_id)
+    continuing = next_trajectory_id is not None and vehicle_id in next_trajectory_id
+    trajectory_df = extract_trajectory(vehicle_df, G, verb=False, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit, stats=stats, 
+                                       continuing=continuing)
+    if next_trajectory_id is not None and len(trajectory_df) > 0:
+        trajectory_df['trajectory_id'] += next_trajectory_id.get(vehicle_id, 0)
+        next_trajectory_id[vehicle_id] = trajectory_df['trajectory_id'].iloc[-1] + 1
+    extraction_time = time.time() - start_time
+    start_time = time.time()
     cleaned_trajectory_df = clean_trajectory(trajectory_df)
+    cleaning_time = time.time() - start_time
+    start_time = time.time()
     recovered_trajectory_df = recover_trajectory(cleaned_trajectory_df, G)
+    recovery_time = time.time() - start_time
+    if stats is not None:
+        times = {'extraction': extraction_time, 'cleaning': cleaning_time, 'recovery': recovery_time,
+                 'path_search': paths.search_time - search_time} # path search time is part of extraction and recovery
+        record_vehicle_stats(stats, vehicle_id, vehicle_df, trajectory_df, cleaned_trajectory_df, recovered_trajectory_df, times, 
+                             paths.dijkstra_calls() - dijkstra_calls, new_vehicle=not continuing)
     if verb:
         print('Trajectories: %s'%(recovered_trajectory_df['trajectory_id'].nunique()))
         print('Road segments: %s'%(len(recovered_trajectory_df)))
     return recovered_trajectory_df
 
 
+def record_vehicle_stats(stats, vehicle_id, vehicle_df, trajectory_df, cleaned_trajectory_df, recovered_trajectory_df, times, dijkstra_calls, new_vehicle=True):
+    # Add the stage times and counts of one vehicle to stats. new_vehicle: False for a vehicle continuing from a previous chunk
+    for stage, seconds in times.items():
+        stats.add_time(stage, seconds)
+    trajectory_ids, road_ids = cleaned_trajectory_df['trajectory_id'].values, cleaned_trajectory_df['road_id'].values
+    moves = np.sum((trajectory_ids[1:] == trajectory_ids[:-1]) & (road_ids[1:] != road_ids[:-1])) # O-D pairs to recover
+    recovered = int(np.sum(recovered_trajectory_df['scenario'].values.astype(float) == 3.1))
+    if new_vehicle:
+        stats.count('vehicles')
+    stats.count('scenario_2.1', len(trajectory_df) - len(cleaned_trajectory_df))
+    stats.count('scenario_3.1', recovered)
+    stats.count('recovered_points', recovered - moves) # intermediate points added by Scenario 3.1
+    stats.count('dijkstra_calls', dijkstra_calls)
+    stats.count('points', len(recovered_trajectory_df))
+    stats.record(vehicle_id=vehicle_id, readings=len(vehicle_df), points=len(recovered_trajectory_df), dijkstra_calls=dijkstra_calls,
+                 **{stage: round(seconds, 6) for stage, seconds in times.items()})
+
+
+def extract_vehicles(grouped_readings, vehicle_ids, G, out_path, time_gap=10, stay_duration=2, speed_limit=120, log_prefix='', stats=None):
+    # Extract and save trajectories for vehicle_ids, in order.
+    # Trajectories are saved every 50 vehicles, as parts in the directory out_path (see trajectory_store.append_trajectory_part).
+    # If out_path exists, resume after the last vehicle saved in it.
+    first_index = 0
+    if os.path.exists(out_path):
+        saved_vehicle_ids = read_trajectory_parts(out_path, columns=['vehicle_id'])['vehicle_id']
+        print('%sNum vehicles processed: %s'%(log_prefix, len(np.unique(saved_vehicle_ids))))
+        if len(saved_vehicle_ids) > 0:
+            last_index = np.where(vehicle_ids.astype(str)==saved_vehicle_ids[-1])[0][0]
+            print('%sLast vehicle index: %s'%(log_prefix, last_index))
+            first_index = last_index + 1
+
+    start_time = time.time()
+    recovered_trajectory_df = pd.DataFrame(columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
+    for i in range(first_index, len(vehicle_ids)):
+        vehicle_id = vehicle_ids[i]
+        print('%sVehicle #%s: %s. Time spent: %s s'%(log_prefix, i, vehicle_id, int(time.time() - start_time)))
+        if i % 50 == 0:
+            print('%sAppending result to file'%(log_prefix))
+            append_trajectory_part(out_path, recovered_trajectory_df)
+            recovered_trajectory_df = pd.DataFrame(columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
+        recovered_trajectory_df = pd.concat([recovered_trajectory_df, get_trajectory(grouped_readings, vehicle_id, G, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit, verb=True, stats=stats)], ignore_index=True)
+    print('%sAppending result to file'%(log_prefix))
+    append_trajectory_part(out_path, recovered_trajectory_df)
+    paths = road_paths(G)
+    print('%s%s'%(log_prefix, paths.summary()))
+    paths.save()
+    return len(vehicle_ids) - first_index
+
+
+def shard_path(parts_path, shard, num_shards):
+    return '%s_shard%dof%d'%(parts_path, shard, num_shards)
+
+
+def init_shard_worker(road_list_path, graph_path, path_radius=None, path_cache_path=None):
+    # Load road network and path service once per worker process
+    global road_list, G
+    road_list = get_road_list(road_df=None, out_path=road_list_path, update=False)
+    G = to_networkx(road_graph(road_df=None, out_path=graph_path, update=False)) # shortest paths need networkx
+    road_paths(G, radius=path_radius, cache_path=path_cache_path)
+
+
+def extract_shard(shard_args):
+    # Worker: extract trajectories for one shard of vehicles into its own parts directory
+    # output: (shard, stats of the shard as dict)
+    shard, num_shards, shard_df, shard_vehicle_ids, parts_path, time_gap, stay_duration, speed_limit = shard_args
+    out_path = shard_path(parts_path, shard, num_shards)
+    stats = PipelineStats()
+    with stats.timer('grouping'):
+        grouped_readings = group_vehicle_readings(shard_df, road_list)
+    extract_vehicles(grouped_readings, shard_vehicle_ids, G, out_path, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit, 
+                     log_prefix='[shard %d/%d] '%(shard, num_shards), stats=stats)
+    return shard, stats.to_dict()
+
+
+def order_trajectory_columns(trajectory_columns, vehicle_ids):
+    # Sort recovered trajectories stably by (vehicle, trajectory_id, timestamp), vehicles in the order of vehicle_ids.
+    # trajectory_columns: dict of column -> np.array (see trajectory_store.PART_COLUMNS)
+    vehicle_order = pd.Series(np.arange(len(vehicle_ids)), index=np.asarray(vehicle_ids).astype(str))
+    order = np.lexsort((trajectory_columns['timestamp'], trajectory_columns['trajectory_id'], vehicle_order.loc[trajectory_columns['vehicle_id']].values))
+    return {column: values[order] for column, values in trajectory_columns.items()}
+
+
+def merge_shards(vehicle_ids, parts_path, num_shards):
+    # Deterministic merge: vehicles in the order of vehicle_ids, readings in shard order within a vehicle
+    # output: dict of column -> np.array (see trajectory_store.PART_COLUMNS). shard parts are removed.
+    shard_paths = [shard_path(parts_path, shard, num_shards) for shard in range(num_shards)]
+    shard_columns = [read_trajectory_parts(path) for path in shard_paths]
+    trajectory_columns = {column: np.concatenate([columns[column] for columns in shard_columns]) for column in shard_columns[0]}
+    for path in shard_paths:
+        os.system('rm -r %s'%(path))
+    return order_trajectory_columns(trajectory_columns, vehicle_ids)
+
+
+def extract_chunks(chunks, road_list, G, out_path, time_gap=10, stay_duration=2, speed_limit=120, stats=None):
+    # Extract and save trajectories chunk by chunk (see read_GPS_chunks), in bounded memory, as parts in the directory out_path.
+    # trajectory_id continues across chunks for each vehicle.
+    # output: vehicle ids in the order of their first reading in the GPS files, as read_GPS_dataset (see order_trajectory_columns)
+    next_trajectory_id = {}
+    first_rows = {} # vehicle_id -> row of its first reading
+    start_time = time.time()
+    for chunk in chunks:
+        start_chunk_time = time.time()
+        grouped_readings = group_vehicle_readings(chunk, road_list)
+        if stats is not None:
+            stats.add_time('grouping', time.time() - start_chunk_time)
+        vehicle_ids = chunk['vehicle_id'].unique()
+        for vehicle_id, row in chunk.groupby('vehicle_id')['row'].min().items():
+            first_rows[vehicle_id] = min(row, first_rows.get(vehicle_id, row))
+        print('Chunk with %s vehicles. Time spent: %s s'%(len(vehicle_ids), int(time.time() - start_time)))
+        recovered_trajectory_df = pd.concat([pd.DataFrame(columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])] + 
+                                            [get_trajectory(grouped_readings, vehicle_id, G, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit, next_trajectory_id=next_trajectory_id, stats=stats) 
+                                             for vehicle_id in vehicle_ids], 
+                                            ignore_index=True)
+        print('Appending result to file')
+        append_trajectory_part(out_path, recovered_trajectory_df)
+    print(road_paths(G).summary())
+    return np.array(sorted(first_rows, key=first_rows.get), dtype=object)
+
+
 if __name__ == '__main__':
     
     
     # Arguments
     parser = argparse.ArgumentParser(description='trajectory')
     parser.add_argument('-d', '--date', help='%Y%m%d', required=True)
+    parser.add_argument('-d2', '--end_date', help='%Y%m%d. same as date by default', default='')
     parser.add_argument('-t', '--test_mode', default=0)
+    parser.add_argument('-j', '--num_workers', help='number of worker processes', default=1)
+    parser.add_argument('-c', '--path_cache', help='path cache file. E.g. data/road_paths.pkl', default='')
+    parser.add_argument('-M', '--max_memory', help='in MB. read GPS dataset in chunks of bounded memory. 0 to read all at once', default=0)
+    parser.add_argument('-e', '--export_csv', help='1: also export recovered trajectories to CSV', default=0)
     args = parser.parse_args()
-    date, test_mode = args.date, int(args.test_mode)
+    date, test_mode, num_workers, path_cache_path, max_memory, export_csv = args.date, int(args.test_mode), int(args.num_workers), args.path_cache, int(args.max_memory), int(args.export_csv)
+    end_date = args.end_date if args.end_date != '' else date
 
 
     # Parameter Settings
     # start_date = '20160325'
     # end_date = '20160325'
     start_date = date
-    end_date = date
+    end_date = end_date
     time_gap = 10 # threshold for trajectory extraction
     stay_duration = 2 # threshold for trajectory extraction
     speed_limit = 120 # threshold for trajectory extraction
@@ -172,60 +470,78 @@ if __name__ == '__main__':
     road_list_path = 'data/road_list.csv'
     graph_path = 'data/road_graph.gml'
     trajectory_path = 'data/recovered_trajectory_df_%s_%s.csv'%(start_date, end_date)
+    store_path = trajectory_store_path(start_date, end_date)
+    parts_path = '%s_parts'%(store_path) # batches of extracted trajectories, until the store is saved
+    stats_path = 'log/trajectory_stats_%s_%s.json'%(start_date, end_date)
+    path_radius = speed_limit * time_gap / 60 + 1 # in km. Dijkstra trees cover the max distance of a valid move in time_gap
+    path_cache_path = path_cache_path if path_cache_path != '' else None
     test_mode = test_mode
     
     
     # Read road network within selected region
     # Set road_df to None: use existing road_list and graph
     road_list = get_road_list(road_df=None, out_path=road_list_path, update=False)
-    G = road_graph(road_df=None, out_path=graph_path, update=False)
+    G = to_networkx(road_graph(road_df=None, out_path=graph_path, update=False)) # shortest paths need networkx
+    road_paths(G, radius=path_radius, cache_path=path_cache_path)
     
     if test_mode:
         print('------- test mode -------')
-    # Read GPS dataset
-    df = read_GPS_dataset(date_range=[start_date, end_date], in_path=GPS_path, test_mode=test_mode)
-    # GPS within selected region
-    df = df.merge(road_list.rename(columns={'road_id':'matched_road_id'}), on='matched_road_id', how='inner')
-    print('Num GPS points:', len(df))
-    print('Num vehicles:', df['vehicle_id'].nunique())
-    
-    # Extract and save trajectories for all vehicles
-    # Trajecotories are saved to file in append mode
-    print('Extracting trajectories for all vehicles to %s'%(trajectory_path))
-    vehicle_ids = df['vehicle_id'].unique()
-    temp_trajectory_path = '%s_temp'%(trajectory_path)
-    if os.path.exists(trajectory_path):
-        os.system('cp %s %s'%(trajectory_path, temp_trajectory_path))
-        recovered_trajectory_df = pd.read_csv(temp_trajectory_path)
-        num_vehicles = recovered_trajectory_df['vehicle_id'].nunique()
-        print('Num vehicles processed:', num_vehicles)
-        if num_vehicles == 0:
-            first_index = 0
-        else:
-            last_vehicle_id = recovered_trajectory_df.iloc[-1]['vehicle_id']
-            last_index = np.where(vehicle_ids==last_vehicle_id)[0][0]
-            print('Last vehicle index:', last_index)
-            first_index = last_index + 1
+    start_time = time.time()
+    stats = PipelineStats() # per-stage times, scenario counts and per-vehicle records of this run
+    if os.path.exists(store_path):
+        print('Trajectory store exists')
+    elif max_memory > 0:
+        # Read GPS dataset in chunks, and extract trajectories chunk by chunk
+        print('Extracting trajectories in chunks of about %d MB'%(max_memory))
+        chunks = read_GPS_chunks(date_range=[start_date, end_date], in_path=GPS_path, road_list=road_list, max_memory=max_memory, time_gap=time_gap, test_mode=test_mode)
+        if os.path.exists(parts_path):
+            os.system('rm -r %s'%(parts_path))
+        vehicle_ids = extract_chunks(chunks, road_list, G, parts_path, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit, stats=stats)
+        trajectory_columns = order_trajectory_columns(read_trajectory_parts(parts_path), vehicle_ids) # parts of a vehicle are spread over chunks
     else:
-        first_index = 0
+        # Read GPS dataset
+        with stats.timer('reading'):
+            df = read_GPS_dataset(date_range=[start_date, end_date], in_path=GPS_path, test_mode=test_mode)
+        # GPS within selected region
+        df = df[df['matched_road_id'].isin(road_list['road_id'])]
+        print('Num GPS points:', len(df))
+        print('Num vehicles:', df['vehicle_id'].nunique())
+    
+        # Extract and save trajectories for all vehicles
+        # Trajecotories are saved in parts, from which an interrupted run resumes
+        print('Extracting trajectories for all vehicles to %s'%(parts_path))
+        vehicle_ids = df['vehicle_id'].unique()
+        if num_workers <= 1:
+            with stats.timer('grouping'):
+                grouped_readings = group_vehicle_readings(df, road_list)
+            extract_vehicles(grouped_readings, vehicle_ids, G, parts_path, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit, stats=stats)
+            trajectory_columns = read_trajectory_parts(parts_path)
+        else:
+            # Vehicles are spread over shards round-robin. Each worker writes (and resumes) its own shard parts.
+            print('Extracting with %d worker processes'%(num_workers))
+            shard_args = []
+            for shard in range(num_workers):
+                shard_vehicle_ids = vehicle_ids[shard::num_workers]
+                shard_df = df[df['vehicle_id'].isin(shard_vehicle_ids)]
+                shard_args.append((shard, num_workers, shard_df, shard_vehicle_ids, parts_path, time_gap, stay_duration, speed_limit))
+            pool = Pool(num_workers, initializer=init_shard_worker, initargs=(road_list_path, graph_path, path_radius, path_cache_path))
+            for shard, shard_stats in pool.imap_unordered(extract_shard, shard_args):
+                print('Shard %d finished. Time spent: %s s'%(shard, int(time.time() - start_time)))
+                stats.merge(shard_stats)
+            pool.close()
+            pool.join()
+            print('Merging shards')
+            trajectory_columns = merge_shards(vehicle_ids, parts_path, num_workers)
 
-    start_time = time.time()
-    recovered_trajectory_df = pd.DataFrame(columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
-    for i in range(first_index, len(vehicle_ids)):
-        vehicle_id = vehicle_ids[i]
-        print('Vehicle #%s: %s. Time spent: %s s'%(i, vehicle_id, int(time.time() - start_time)))
-        if i == 0:
-            print('Saving header to file')
-            recovered_trajectory_df.to_csv(temp_trajectory_path, index=False) # save header to file
-        if i % 50 == 0:
-            print('Appending result to file')
-            recovered_trajectory_df.to_csv(temp_trajectory_path, mode='a', index=False, header=False)
-            recovered_trajectory_df = pd.DataFrame(columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
-        recovered_trajectory_df = recovered_trajectory_df.append(get_trajectory(df, vehicle_id, G, time_gap=time_gap, stay_duration=stay_duration, speed_limit=speed_limit, verb=True), ignore_index=True)
-    print('Appending result to file')
-    recovered_trajectory_df.to_csv(temp_trajectory_path, mode='a', index=False, header=False)
-    if os.path.exists(trajectory_path):
-        os.system('rm %s'%(trajectory_path))
-    os.system('mv %s %s'%(temp_trajectory_path, trajectory_path))
+    # Save to the trajectory store, from the extracted columns. CSV only as export, if required.
+    if not os.path.exists(store_path):
+        with stats.timer('store'):
+            write_trajectory_store(trajectory_columns, store_path, road_list)
+        if os.path.exists(parts_path):
+            os.system('rm -r %s'%(parts_path))
+        stats.add_time('total', time.time() - start_time)
+        print(stats.summary())
+        stats.save(stats_path)
+    if export_csv:
+        export_trajectory_csv(store_path, trajectory_path)
     print('Finished trajectory extraction. Total time spent: %.2f hour.'%((time.time() - start_time)/3600))
-       
@@ -0,0 +1,171 @@
+# python trajectory_store.py -d1 20160314 -d2 20160314 [-e 1]
+import os
+import glob
+import argparse
+import numpy as np
+import pandas as pd
+from utils import to_timestamp, to_time_string, date_timestamp
+from road_graph import get_road_list
+
+
+# Binary columnar store of recovered trajectories. One directory per date range, one .npy file per column:
+#   vehicle_index: int32. code of vehicle_id in vehicles.csv
+#   trajectory_id: int32
+#   timestamp: int64. seconds, see utils.to_timestamp
+#   road_index: int32. index of road_id in road_ids.npy (i.e. road_list)
+#   scenario: float32
+STORE_COLUMNS = ['vehicle_index', 'trajectory_id', 'timestamp', 'road_index', 'scenario']
+# While trajectory.py extracts trajectories, each batch of vehicles is saved as a part of encoded columns
+# (part%06d.npz in a parts directory), from which extraction resumes and the store is built. Columns:
+#   vehicle_id: str. trajectory_id: int32. timestamp: int64 seconds. road_id: int64. scenario: float32
+PART_COLUMNS = ['vehicle_id', 'trajectory_id', 'timestamp', 'road_id', 'scenario']
+
+
+def trajectory_store_path(start_date, end_date):
+    return 'data/recovered_trajectory_%s_%s'%(start_date, end_date)
+
+
+def encode_trajectory(recovered_trajectory_df):
+    # recovered_trajectory_df: columns ['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario']
+    # output: dict of column -> np.array (see PART_COLUMNS). times are parsed to seconds here, once.
+    return {'vehicle_id': recovered_trajectory_df['vehicle_id'].values.astype(str),
+            'trajectory_id': recovered_trajectory_df['trajectory_id'].values.astype(np.int32),
+            'timestamp': to_timestamp(recovered_trajectory_df['time']).astype(np.int64),
+            'road_id': recovered_trajectory_df['road_id'].values.astype(np.int64),
+            'scenario': recovered_trajectory_df['scenario'].values.astype(np.float32)}
+
+
+def append_trajectory_part(parts_path, recovered_trajectory_df):
+    # Save a batch of recovered trajectories as the next part. Written under a temporary name, so that parts are complete.
+    if not os.path.exists(parts_path):
+        os.makedirs(parts_path)
+    part_path = os.path.join(parts_path, 'part%06d.npz'%(len(glob.glob(os.path.join(parts_path, 'part*.npz')))))
+    temp_part_path = '%s_temp.npz'%(part_path[:-4])
+    np.savez(temp_part_path, **encode_trajectory(recovered_trajectory_df))
+    os.rename(temp_part_path, part_path)
+
+
+def read_trajectory_parts(parts_path, columns=None):
+    # output: dict of column -> np.array (see PART_COLUMNS), parts concatenated in order
+    columns = PART_COLUMNS if columns is None else list(columns)
+    parts = [np.load(path) for path in sorted(glob.glob(os.path.join(parts_path, 'part*.npz')))]
+    if len(parts) == 0:
+        return encode_trajectory(pd.DataFrame(columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario']))
+    return {column: np.concatenate([part[column] for part in parts]) for column in columns}
+
+
+def write_trajectory_store(trajectory_columns, store_path, road_list):
+    # trajectory_columns: dict of column -> np.array (see PART_COLUMNS)
+    print('Saving trajectory store at %s'%(store_path))
+    temp_store_path = '%s_temp'%(store_path)
+    if not os.path.exists(temp_store_path):
+        os.makedirs(temp_store_path)
+    vehicle_index, vehicle_ids = pd.factorize(trajectory_columns['vehicle_id'])
+    road_ids = road_list['road_id'].values.astype(np.int64)
+    road_index = pd.Series(np.arange(len(road_ids)), index=road_ids).loc[trajectory_columns['road_id']].values
+    columns = {'vehicle_index': vehicle_index.astype(np.int32),
+               'trajectory_id': trajectory_columns['trajectory_id'],
+               'timestamp': trajectory_columns['timestamp'],
+               'road_index': road_index.astype(np.int32),
+               'scenario': trajectory_columns['scenario']}
+    for column in STORE_COLUMNS:
+        np.save(os.path.join(temp_store_path, '%s.npy'%(column)), columns[column])
+    np.save(os.path.join(temp_store_path, 'road_ids.npy'), road_ids)
+    pd.DataFrame({'vehicle_id': vehicle_ids}).to_csv(os.path.join(temp_store_path, 'vehicles.csv'), index=False)
+    if os.path.exists(store_path):
+        os.system('rm -r %s'%(store_path))
+    os.system('mv %s %s'%(temp_store_path, store_path))
+    print('Saved.')
+
+
+def read_trajectory_store(store_path, columns=None, start_date=None, end_date=None, start_time=None, end_time=None, mmap=True):
+    # columns: subset of STORE_COLUMNS. None for all.
+    # start_date, end_date: '%Y%m%d'. if set, only points in [start_date 00:00:00, end_date 23:59:59] are returned.
+    # start_time, end_time: int64 seconds (see utils.to_timestamp). if set, only points in [start_time, end_time) are returned.
+    # mmap: memory-map the column files. Points of a time range are selected by a mask over the memory-mapped timestamp column,
+    #       and only their rows are read from the other columns. Without a time range, the returned arrays are read-only views of the files.
+    # output: dict of column -> np.array
+    columns = STORE_COLUMNS if columns is None else list(columns)
+    mmap_mode = 'r' if mmap else None
+    load = lambda column: np.load(os.path.join(store_path, '%s.npy'%(column)), mmap_mode=mmap_mode)
+    store = {column: load(column) for column in columns}
+    if start_date is not None:
+        start_time = date_timestamp(start_date) if start_time is None else max(start_time, date_timestamp(start_date))
+    if end_date is not None:
+        end_time = date_timestamp(end_date) + 86400 if end_time is None else min(end_time, date_timestamp(end_date) + 86400)
+    if start_time is not None or end_time is not None:
+        timestamp = store['timestamp'] if 'timestamp' in store else load('timestamp')
+        mask = np.ones(len(timestamp), dtype=bool)
+        if start_time is not None:
+            mask &= timestamp >= start_time
+        if end_time is not None:
+            mask &= timestamp < end_time
+        rows = np.flatnonzero(mask)
+        store = {column: np.asarray(values[rows]) for column, values in store.items()}
+    return store
+
+
+def read_store_dictionaries(store_path):
+    # output: (vehicle_ids, road_ids). vehicle_ids[vehicle_index], road_ids[road_index]
+    vehicle_ids = pd.read_csv(os.path.join(store_path, 'vehicles.csv'), dtype={'vehicle_id': str})['vehicle_id'].values
+    road_ids = np.load(os.path.join(store_path, 'road_ids.npy'))
+    return vehicle_ids, road_ids
+
+
+def read_recovered_trajectory(start_date, end_date, road_list, columns=None):
+    # Recovered trajectories as columns, from the store if it exists, otherwise from the CSV file.
+    # output: dict of column -> np.array (see STORE_COLUMNS)
+    store_path = trajectory_store_path(start_date, end_date)
+    if os.path.exists(store_path):
+        print('Reading trajectory store')
+        store = read_trajectory_store(store_path, columns=columns)
+        _, road_ids = read_store_dictionaries(store_path)
+        if 'road_index' in store and not np.array_equal(road_ids, road_list['road_id'].values):
+            # stored road index refers to another road_list: map it to the current one
+            road_index = pd.Series(np.arange(len(road_list)), index=road_list['road_id'].values).reindex(road_ids).fillna(-1).values.astype(np.int32)
+            store['road_index'] = road_index[store['road_index']]
+        return store
+    print('Reading trajectory CSV')
+    recovered_trajectory_df = pd.read_csv('data/recovered_trajectory_df_%s_%s.csv'%(start_date, end_date), dtype={'vehicle_id': str})
+    road_index = pd.Series(np.arange(len(road_list)), index=road_list['road_id'].values)
+    store = {'vehicle_index': pd.factorize(recovered_trajectory_df['vehicle_id'])[0].astype(np.int32),
+             'trajectory_id': recovered_trajectory_df['trajectory_id'].values.astype(np.int32),
+             'timestamp': to_timestamp(recovered_trajectory_df['time']),
+             'road_index': road_index.reindex(recovered_trajectory_df['road_id'].values).fillna(-1).values.astype(np.int32),
+             'scenario': recovered_trajectory_df['scenario'].values.astype(np.float32)}
+    columns = STORE_COLUMNS if columns is None else columns
+    return {column: store[column] for column in columns}
+
+
+def export_trajectory_csv(store_path, csv_path):
+    # Export a trajectory store to the CSV format of trajectory.py
+    print('Exporting trajectory store to %s'%(csv_path))
+    store = read_trajectory_store(store_path)
+    vehicle_ids, road_ids = read_store_dictionaries(store_path)
+    recovered_trajectory_df = pd.DataFrame({'vehicle_id': vehicle_ids[store['vehicle_index']],
+                                            'trajectory_id': store['trajectory_id'],
+                                            'time': to_time_string(store['timestamp']),
+                                            'road_id': road_ids[store['road_index']],
+                                            'scenario': store['scenario'].astype(np.float64).round(1)},
+                                           columns=['vehicle_id', 'trajectory_id', 'time', 'road_id', 'scenario'])
+    recovered_trajectory_df.to_csv(csv_path, index=False)
+    return recovered_trajectory_df
+
+
+if __name__ == '__main__':
+
+    # Convert recovered_trajectory_df CSV to trajectory store, or export it back with -e 1
+    parser = argparse.ArgumentParser(description='trajectory_store')
+    parser.add_argument('-d1', '--start_date', help='%Y%m%d', required=True)
+    parser.add_argument('-d2', '--end_date', help='%Y%m%d', required=True)
+    parser.add_argument('-e', '--export', help='1: export store to CSV', default=0)
+    args = parser.parse_args()
+    start_date, end_date, export = args.start_date, args.end_date, int(args.export)
+
+    store_path = trajectory_store_path(start_date, end_date)
+    csv_path = 'data/recovered_trajectory_df_%s_%s.csv'%(start_date, end_date)
+    if export:
+        export_trajectory_csv(store_path, csv_path)
+    else:
+        road_list = get_road_list(road_df=None, out_path='data/road_list.csv', update=False)
+        write_trajectory_store(encode_trajectory(pd.read_csv(csv_path, dtype={'vehicle_id': str})), store_path, road_list)
@@ -6,89 +6,216 @@ from datetime import datetime as dt
 import os
 from utils import *
 import numpy as np
+import scipy.sparse as sp
 from math import radians, degrees, sin, cos, asin, acos, sqrt
 import pickle as pkl
 import argparse
+from multiprocessing import Pool
 from road_graph import get_road_list
+from trajectory_store import read_recovered_trajectory
 
 
-def extract_trajectory_transition(start_date, end_date, interval=15):
+# Trajectory transition of a date range: list of 60//interval*24 sparse matrices (scipy.sparse.csr_matrix) of shape (n_road, n_road).
+# transition[t][i, j]: number of moves from road index i to road index j in time slot t.
+# Saved as npz of the non-zero (slot, from_index, to_index, count).
+
+def transition_path(start_date, end_date, interval=15):
+    if interval != 15:
+        return 'data/trajectory_transition_%s_%s_%dmin.npz'%(start_date, end_date, interval)
+    return 'data/trajectory_transition_%s_%s.npz'%(start_date, end_date)
+
+
+def sparse_transition(slots, from_index, to_index, counts, shape, dtype=np.int32):
+    # shape: (n_slot, n_road, n_road). Counts of duplicate (slot, from_index, to_index) are summed.
+    order = np.argsort(slots, kind='mergesort')
+    slots, from_index, to_index, counts = slots[order], from_index[order], to_index[order], np.asarray(counts, dtype=dtype)[order]
+    bounds = np.searchsorted(slots, np.arange(shape[0] + 1))
+    return [sp.csr_matrix((counts[start:end], (from_index[start:end], to_index[start:end])), shape=shape[1:], dtype=dtype) 
+            for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def save_transition(file_path, transition):
+    triples = [matrix.tocoo() for matrix in transition]
+    np.savez_compressed(file_path, 
+                        slot=np.concatenate([np.full(coo.nnz, slot, dtype=np.int32) for slot, coo in enumerate(triples)]),
+                        from_index=np.concatenate([coo.row.astype(np.int32) for coo in triples]),
+                        to_index=np.concatenate([coo.col.astype(np.int32) for coo in triples]),
+                        count=np.concatenate([coo.data for coo in triples]),
+                        shape=np.array((len(transition),) + transition[0].shape))
+
+
+def load_transition(file_path):
+    # file_path: npz file, or dense tensor of former versions pickled in .pkl, converted to sparse
+    if file_path.endswith('.pkl'):
+        with open(file_path, 'rb') as f:
+            dense_transition = pkl.load(f)
+        slots, from_index, to_index = np.nonzero(dense_transition)
+        return sparse_transition(slots, from_index, to_index, dense_transition[slots, from_index, to_index], dense_transition.shape, dtype=dense_transition.dtype)
+    with np.load(file_path) as data:
+        return sparse_transition(data['slot'], data['from_index'], data['to_index'], data['count'], tuple(data['shape']), dtype=data['count'].dtype)
+
+
+def find_transition(start_date, end_date, interval=15):
+    # path of the saved transition of a date range, or None.
+    # Dense .pkl files of former versions are accepted for single dates only: their range totals were summed in int8/int16
+    # and may have wrapped around, so ranges are summed again from dates (see tree_reduce).
+    paths = [transition_path(start_date, end_date, interval=interval)]
+    if interval == 15 and start_date == end_date:
+        paths.append('data/trajectory_transition_%s_%s.pkl'%(start_date, end_date))
+    for path in paths:
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def count_transitions(vehicle_index, trajectory_ids, road_index, timestamps, shape, interval=15):
+    # Moves between consecutive points of the same vehicle and trajectory to a different road segment, in the time slot of the origin point.
+    # inputs: arrays of recovered trajectory points, sorted by (vehicle, trajectory, time). road_index: -1 for roads out of road_list.
+    move = (vehicle_index[1:] == vehicle_index[:-1]) & (trajectory_ids[1:] == trajectory_ids[:-1]) & (road_index[1:] != road_index[:-1])
+    return count_moves(move, road_index, timestamps, shape, interval=interval)
+
+
+def count_moves(move, road_index, timestamps, shape, interval=15):
+    # Transition of the moves from point k to point k + 1 where move[k] is True, ignoring roads out of road_list.
+    move = move & (road_index[:-1] >= 0) & (road_index[1:] >= 0)
+    slots = time_index(timestamps[:-1][move], interval=interval)
+    return sparse_transition(slots, road_index[:-1][move], road_index[1:][move], np.ones(np.sum(move)), shape, dtype=np.int32)
+
+
+def build_day_transition(day_args):
+    # Worker: trajectory transition of one date, loaded if saved, otherwise counted and saved.
+    # output: (date, transition)
+    current_date, interval, road_list = day_args
+    file_path = find_transition(current_date, current_date, interval=interval)
+    if file_path is not None:
+        print('Date %s: file exists'%(current_date))
+        return current_date, load_transition(file_path)
+    start_time = time.time()
+    shape = (60//interval*24, len(road_list), len(road_list))
+    trajectory = read_recovered_trajectory(current_date, current_date, road_list, columns=['vehicle_index', 'trajectory_id', 'timestamp', 'road_index'])
+    trajectory_transition = count_transitions(trajectory['vehicle_index'], trajectory['trajectory_id'], trajectory['road_index'], trajectory['timestamp'], 
+                                              shape, interval=interval)
+    save_transition(transition_path(current_date, current_date, interval=interval), trajectory_transition)
+    print('Date %s: %d points counted in %.2f seconds'%(current_date, len(trajectory['road_index']), time.time() - start_time))
+    return current_date, trajectory_transition
+
+
+def add_transitions(pair):
+    # Sum of two transitions. second: None to return first as is.
+    first, second = pair
+    if second is None:
+        return first
+    return [first_matrix + second_matrix for first_matrix, second_matrix in zip(first, second)]
+
+
+def tree_reduce(transitions, pool=None):
+    # Sum of a list of transitions, in int64, by pairwise tree reduction: each round sums independent pairs (in parallel with pool).
+    transitions = [[matrix.astype(np.int64) for matrix in transition] for transition in transitions]
+    while len(transitions) > 1:
+        pairs = [(transitions[k], transitions[k + 1] if k + 1 < len(transitions) else None) for k in range(0, len(transitions), 2)]
+        transitions = pool.map(add_transitions, pairs) if pool is not None else [add_transitions(pair) for pair in pairs]
+    return transitions[0]
+
+
+def transition_nbytes(transition):
+    return sum(matrix.data.nbytes + matrix.indices.nbytes + matrix.indptr.nbytes for matrix in transition)
+
+
+# Aggregates of date ranges are assembled from aligned blocks of dates, as in a segment tree over days:
+# a block of level k covers 2^k dates, starting at a day number (days since 1970-01-01) that is a multiple of 2^k.
+# Each block is saved as the transition of its date range, and built from its two halves.
+# Any date range is covered by O(log(days)) blocks, and sliding a window by one date only counts the new date.
+
+def day_number(date):
+    return date_timestamp(date) // 86400
+
+
+def day_date(day):
+    return (dt(1970, 1, 1) + timedelta(int(day))).strftime('%Y%m%d')
+
+
+def aligned_blocks(start_date, end_date):
+    # output: list of (block_start_date, block_end_date) covering start_date to end_date
+    blocks = []
+    day, end_day = day_number(start_date), day_number(end_date)
+    while day <= end_day:
+        size = 1
+        while day % (size * 2) == 0 and day + size * 2 - 1 <= end_day:
+            size *= 2
+        blocks.append((day_date(day), day_date(day + size - 1)))
+        day += size
+    return blocks
+
+
+def block_halves(start_date, end_date):
+    start_day, end_day = day_number(start_date), day_number(end_date)
+    middle_day = (start_day + end_day) // 2
+    return (start_date, day_date(middle_day)), (day_date(middle_day + 1), end_date)
+
+
+def missing_dates(start_date, end_date, interval=15):
+    # dates to count to build the block, i.e. not covered by saved blocks
+    if find_transition(start_date, end_date, interval=interval) is not None:
+        return []
+    if start_date == end_date:
+        return [start_date]
+    (first_start, first_end), (second_start, second_end) = block_halves(start_date, end_date)
+    return missing_dates(first_start, first_end, interval=interval) + missing_dates(second_start, second_end, interval=interval)
+
+
+def build_block(start_date, end_date, interval=15, days=None):
+    # Transition of an aligned block: loaded if saved, otherwise the sum of its two halves (saved).
+    # days: None, or dict of transitions of dates built already, by date
+    if start_date == end_date and days is not None and start_date in days:
+        return days[start_date]
+    file_path = find_transition(start_date, end_date, interval=interval)
+    if file_path is not None:
+        return load_transition(file_path)
+    (first_start, first_end), (second_start, second_end) = block_halves(start_date, end_date)
+    transition = tree_reduce([build_block(first_start, first_end, interval=interval, days=days), 
+                              build_block(second_start, second_end, interval=interval, days=days)])
+    print('Saving block %s-%s'%(start_date, end_date))
+    save_transition(transition_path(start_date, end_date, interval=interval), transition)
+    return transition
+
+
+def extract_trajectory_transition(start_date, end_date, interval=15, num_workers=1):
     # start_date, end_date = '20160401', '20160421'
     # interval is in minutes, and should divide 60.
+    # num_workers: number of processes building dates in parallel
     
-    total_file_path = 'data/trajectory_transition_%s_%s.pkl'%(start_date, end_date)
-    if os.path.exists(total_file_path):
-        with open(total_file_path, 'rb') as f:
-            print('Total file exists')
-            total_trajectory_transition = pkl.load(f)
+    if find_transition(start_date, end_date, interval=interval) is not None:
+        print('Total file exists')
+        total_trajectory_transition = load_transition(find_transition(start_date, end_date, interval=interval))
     else:
         print('Reading road list')
         road_list = get_road_list()
         road_list = road_list.reset_index().rename(columns={'index':'road_index'})
         
-        print('Creating empty total_trajectory_transition')
-        total_trajectory_transition = np.zeros((60//interval*24, len(road_list), len(road_list)), dtype=np.int8)
-        
-        date_list = date_range(start_date, end_date)
+        blocks = aligned_blocks(start_date, end_date)
+        print('Date range covered by %d blocks: %s'%(len(blocks), ', '.join('%s-%s'%(block) for block in blocks)))
+        date_list = [current_date for block in blocks for current_date in missing_dates(*block, interval=interval)]
+        day_args = [(current_date, interval, road_list) for current_date in date_list]
+        pool = Pool(num_workers) if num_workers > 1 and len(date_list) > 1 else None
         
-        for current_date in date_list:
-            
-            print('Date %s'%(current_date))
-            file_path = 'data/trajectory_transition_%s_%s.pkl'%(current_date, current_date)
-            if os.path.exists(file_path):
-                print('File exists')
-                with open(file_path, 'rb') as f:
-                    trajectory_transition = pkl.load(f)
-                
-            else:
-                start_time = time.time()
-                
-                print('Reading recovered_trajectory_df')
-                trajectory_path = 'data/recovered_trajectory_df_%s_%s.csv'%(current_date, current_date)
-                recovered_trajectory_df = pd.read_csv(trajectory_path)
-                print('Time spent till now: %.2f seconds'%(time.time() - start_time))
-
-                print('Extracting road index')
-                recovered_trajectory_df = recovered_trajectory_df.merge(road_list, on='road_id', how='left')
-                print('Time spent till now: %.2f seconds'%(time.time() - start_time))
-
-                print('Extracting time_index')
-                def extract_time_index(time):
-                    hour = int(time[-8:-6])
-                    minute = int(time[-5:-3])
-                    time_index = hour * 4 + minute // 15
-                    return time_index
-                recovered_trajectory_df['time_index'] = recovered_trajectory_df['time'].apply(extract_time_index)
-                print('Time spent till now: %.2f seconds'%(time.time() - start_time))
-
-                print('Creating empty trajectory_transition')
-                trajectory_transition = np.zeros((60//interval*24, len(road_list), len(road_list)), dtype=np.int16)
-                print('Time spent till now: %.2f seconds'%(time.time() - start_time))
-
-                print('Calculating trajectory_transition')
-                for i, row in recovered_trajectory_df.iterrows():
-                    if i != 0:
-                        if previous_row['vehicle_id'] == row['vehicle_id'] and \
-                        previous_row['trajectory_id'] == row['trajectory_id'] and \
-                        previous_row['road_id'] != row['road_id']:
-                            trajectory_transition[previous_row['time_index'], previous_row['road_index'], row['road_index']] += 1
-                    if i % 100000 == 0:
-                        print(i, 'at %.2f seconds'%(time.time() - start_time))
-                    previous_row = row
-                print('Time spent till now: %.2f seconds'%(time.time() - start_time))
-
-                print('Saving trajectory_transition')
-                with open(file_path, 'wb') as f:
-                    pkl.dump(trajectory_transition, f)
-                print('Time spent till now: %.2f seconds'%(time.time() - start_time))
-            
-            print('Merging trajectory transition')
-            total_trajectory_transition = total_trajectory_transition + trajectory_transition
-            print('Total count: %d'%(total_trajectory_transition.sum()))
+        # build each missing date, in parallel with pool
+        start_time = time.time()
+        print('Building trajectory transition of %d dates with %d worker processes'%(len(date_list), num_workers if pool is not None else 1))
+        built_days = pool.imap_unordered(build_day_transition, day_args) if pool is not None else map(build_day_transition, day_args)
+        days = {}
+        for current_date, trajectory_transition in built_days:
+            days[current_date] = trajectory_transition
+            print('Date %s finished (%d/%d). Time spent: %.2f seconds. Non-zero: %d. Transitions in memory: %.1f MB. Peak memory: %.1f MB'%(
+                current_date, len(days), len(date_list), time.time() - start_time, sum(matrix.nnz for matrix in trajectory_transition), 
+                sum(transition_nbytes(transition) for transition in days.values()) / 2**20, peak_memory()))
         
-        print('Saving total_trajectory_transition')
-        with open(total_file_path, 'wb') as f:
-            pkl.dump(total_trajectory_transition, f)
+        print('Merging trajectory transition')
+        total_trajectory_transition = tree_reduce([build_block(block_start, block_end, interval=interval, days=days) for block_start, block_end in blocks], pool=pool)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        print('Total count: %d. Time spent: %.2f seconds. Peak memory: %.1f MB'%(
+            sum(matrix.sum() for matrix in total_trajectory_transition), time.time() - start_time, peak_memory()))
         
     return total_trajectory_transition
 
@@ -99,8 +226,10 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='trajectory_transition')
     parser.add_argument('-d1', '--start_date', help='%Y%m%d', required=True)
     parser.add_argument('-d2', '--end_date', help='%Y%m%d', required=True)
+    parser.add_argument('-i', '--interval', help='in minutes. should divide 60', default=15)
+    parser.add_argument('-j', '--num_workers', help='number of worker processes', default=1)
     args = parser.parse_args()
-    start_date, end_date = args.start_date, args.end_date
+    start_date, end_date, interval, num_workers = args.start_date, args.end_date, int(args.interval), int(args.num_workers)
     
     # start_date, end_date = '20160401', '20160421'
-    trajectory_transition = extract_trajectory_transition(start_date, end_date)
\ No newline at end of file
+    trajectory_transition = extract_trajectory_transition(start_date, end_date, interval=interval, num_workers=num_workers)
\ No newline at end of file
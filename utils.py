@@ -1,5 +1,9 @@
 import os
+import json
+import resource
+from contextlib import contextmanager
 import numpy as np
+import pandas as pd
 import geopy.distance
 import time
 from datetime import date, timedelta
@@ -29,10 +33,43 @@ def date_range(date1, date2):
     return date_list
 
 
+# Time representation: int64 seconds since epoch of the local (naive) time.
+# Time strings are parsed once per file with to_timestamp, and converted back with to_time_string only at output.
+TIME_FORMAT = '%d/%m/%Y %H:%M:%S'
+
+
 def time_difference(time1, time2):
     # format: '25/03/2016 00:00:04'
     # time_difference = time1 - time2
-    return (dt.strptime(time1, '%d/%m/%Y %H:%M:%S') - dt.strptime(time2, '%d/%m/%Y %H:%M:%S')).total_seconds()
+    return (dt.strptime(time1, TIME_FORMAT) - dt.strptime(time2, TIME_FORMAT)).total_seconds()
+
+
+def to_timestamp(times):
+    # format: '25/03/2016 00:00:04'
+    # vectorized parsing of time strings to int64 seconds. differences match time_difference.
+    return pd.to_datetime(pd.Series(times), format=TIME_FORMAT).values.astype('datetime64[s]').astype(np.int64)
+
+
+def to_time_string(timestamps):
+    # int64 seconds to time strings. output: np.array of '25/03/2016 00:00:04'
+    return np.array(pd.to_datetime(np.asarray(timestamps, dtype=np.int64), unit='s').strftime(TIME_FORMAT), dtype=object)
+
+
+def date_timestamp(date):
+    # date: '%Y%m%d'. output: timestamp of 00:00:00 of the date
+    return int((dt.strptime(date, '%Y%m%d') - dt(1970, 1, 1)).total_seconds())
+
+
+def round_timestamp(timestamps, interval=5):
+    # start of the interval of each timestamp. interval: in minutes
+    interval = interval * 60 # convert minutes to seconds
+    return np.asarray(timestamps, dtype=np.int64) // interval * interval
+
+
+def time_index(timestamps, interval=5):
+    # index of the interval within its day. E.g. 0-95 for 15-minute intervals. interval: in minutes
+    interval = interval * 60 # convert minutes to seconds
+    return np.asarray(timestamps, dtype=np.int64) % 86400 // interval
 
 
 def df_to_csv(df, file_path, index=False):
@@ -57,15 +94,71 @@ def round_time(t, interval=5):
     # output: '25/03/2016 12:25:00'
     # interval: in minutes
     interval = interval * 60 # convert minutes to seconds
-    datetime = dt.strptime(t, '%d/%m/%Y %H:%M:%S')
+    datetime = dt.strptime(t, TIME_FORMAT)
     new_datetime = dt.fromtimestamp(int(time.mktime(datetime.timetuple())) // interval * interval)
     return new_datetime.strftime('%d/%m/%Y %H:%M:%S')
 
 
+def peak_memory():
+    # peak resident memory of this process plus that of its largest finished child process, in MB
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss + resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return usage / 1024 # ru_maxrss is in KB on Linux
+
+
 def geodistance(coords_1, coords_2):
     return geopy.distance.great_circle(coords_1, coords_2).m
 
 
+class PipelineStats():
+    # Instrumentation of a pipeline run: time per stage, counters, and one record per item (e.g. per vehicle).
+    # Stats of worker processes are combined with merge. save writes a JSON summary.
+
+    def __init__(self):
+        self.timers = {} # stage -> seconds
+        self.counters = {} # name -> count
+        self.records = [] # list of dicts
+
+    @contextmanager
+    def timer(self, stage):
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.time() - start_time)
+
+    def add_time(self, stage, seconds):
+        self.timers[stage] = self.timers.get(stage, 0.) + seconds
+
+    def count(self, name, n=1):
+        self.counters[name] = self.counters.get(name, 0) + int(n)
+
+    def record(self, **values):
+        self.records.append(values)
+
+    def merge(self, other):
+        # other: PipelineStats, or its to_dict()
+        other = other if isinstance(other, dict) else other.to_dict()
+        for stage, seconds in other['timers'].items():
+            self.add_time(stage, seconds)
+        for name, n in other['counters'].items():
+            self.count(name, n)
+        self.records += other['records']
+        return self
+
+    def to_dict(self):
+        return {'timers': dict(self.timers), 'counters': dict(self.counters), 'records': list(self.records)}
+
+    def summary(self):
+        timers = ', '.join('%s %.2f s'%(stage, seconds) for stage, seconds in sorted(self.timers.items(), key=lambda item: -item[1]))
+        counters = ', '.join('%s %d'%(name, n) for name, n in sorted(self.counters.items()))
+        return 'Time: %s\nCounts: %s'%(timers, counters)
+
+    def save(self, out_path):
+        print('Saving stats to %s'%(out_path))
+        with open(out_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=1, default=lambda value: value.item() if hasattr(value, 'item') else str(value))
+
+
 ##### Visualization #####
 ##### The code below for displaying road segments, road network, and vehicle trajectories
 #